@@ -1,26 +1,154 @@
+import concurrent.futures
 import pathlib
 import json
-import subprocess
-import time
 import modal
 import random
 import os
-import datetime
+import threading
+import time
+from typing import List, Literal, Optional
 
-from .container import image, gpu
-from pydantic import BaseModel
+from .container import (
+    image,
+    gpu,
+    concurrent_inputs,
+    max_containers,
+    tenant_weights,
+    cache_lru,
+    persist_preprocessed,
+)
+from .server import ComfyServer, ComfyServerError, PromptInterrupted
+from .progress import ProgressWriter
+from .timings import Timings, variant_stage
+from .records import FirestoreBackend, JobRecords
+from .encoding import DEFAULT_OUTPUT_ENCODING, OutputEncoding, encode_image
+from .events import TERMINAL_EVENTS, EventPublisher
+from .signing import SignedUrlCache
+from .idempotency import IdempotencyStore
+from .cache import (
+    CACHED_JOB_PREFIX,
+    ResultCache,
+    image_hash,
+    image_key,
+    result_blob_name,
+)
+from .preprocessing import PreprocessorCache, write_file
+from .scheduler import FairScheduler, QueueFull
+from .workflows import (
+    WORKFLOWS,
+    WorkflowTemplate,
+    load_workflow,
+    missing_models,
+    subgraph,
+)
+from pydantic import BaseModel, Field
 
 app = modal.App("comfy-api")
 
+# Live progress of running jobs, partitioned by job id
+job_events = modal.Queue.from_name("comfy-api-events", create_if_missing=True)
+# Jobs a GPU container has picked up, so queued and running can be told apart
+job_states = modal.Dict.from_name("comfy-api-job-states", create_if_missing=True)
+# Workflow and last heartbeat of every GPU container with its models loaded,
+# by task id
+warm_containers = modal.Dict.from_name(
+    "comfy-api-warm-containers", create_if_missing=True
+)
+# Outcome of every ticket handed out for a job still in the API's queue, so a
+# ticket still resolves after the API container that issued it is gone
+queued_jobs = modal.Dict.from_name("comfy-api-queued-jobs", create_if_missing=True)
+# The prewarm window requested through POST /warmup
+warmup_window = modal.Dict.from_name("comfy-api-warmup-window", create_if_missing=True)
+
+GPU_IDLE_TIMEOUT = 60 * 10  # 10 minutes
+# How often a warm container reports that it is still up
+WARM_HEARTBEAT_SECONDS = 60
+
+# Upper bound for long-polls, kept below typical proxy idle timeouts
+MAX_POLL_SECONDS = 55
+# Most jobs accepted by a single POST /jobs
+MAX_BATCH_JOBS = 100
+# Largest photo accepted by POST /job/upload
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+# Most images a single job generates
+MAX_VARIANTS = 8
+# Largest seed ComfyUI's KSampler accepts
+MAX_SEED = 2**64 - 1
+# Budget of a single-image generation, and what each extra variant adds
+PROMPT_SECONDS = 60 * 2
+VARIANT_SECONDS = 20
+# An input can wait in ComfyUI's queue behind the largest batches of every
+# other input of its container, and that wait counts toward its timeout
+INFER_TIMEOUT = concurrent_inputs * (
+    PROMPT_SECONDS + (MAX_VARIANTS - 1) * VARIANT_SECONDS
+)
+# How long POST /job waits for a free GPU slot before handing out a ticket
+ADMIT_SECONDS = 5
+# Job ids handed out for jobs still waiting in the API's queue
+QUEUED_JOB_PREFIX = "queued-"
+# How long a ticket can be resolved to the job it was spawned as
+TICKET_TTL = 60 * 60
+
 
 class InferModel(BaseModel):
     session_id: str
     prompt: str
+    # "reference" only returns where the output was uploaded; "inline" also
+    # ships the image back as a base64 data URL
+    result_mode: Literal["reference", "inline"] = "reference"
+    output: OutputEncoding = DEFAULT_OUTPUT_ENCODING
+    # Stream low resolution latent previews to /events/{job_id}
+    previews: bool = False
+    # Client-chosen id; retries with the same id map to the original job
+    request_id: Optional[str] = None
+    # A fixed seed makes the generation deterministic and its result cacheable
+    seed: Optional[int] = Field(None, ge=0, le=MAX_SEED)
+    # Booth (or tenant) the job is queued under for fair sharing of the GPUs
+    booth_id: Optional[str] = None
+    # Entry of the workflow registry to run, see workflows.py
+    workflow: str = "default"
+    # Images generated from one sampler pass, as one latent batch
+    variants: int = Field(1, ge=1, le=MAX_VARIANTS)
+
+
+class JobImage(BaseModel):
+    signed_url: Optional[str] = None
+    blob: str
+    size: int
+    base64_image: Optional[str] = None
 
 
 class JobResult(BaseModel):
-    base64_image: str
+    # The first image; every image of the job is listed under `variants`
     signed_url: str
+    blob: str
+    size: int
+    content_type: str
+    timings: dict = {}
+    base64_image: Optional[str] = None
+    variants: List[JobImage] = []
+
+
+class JobSubmission(BaseModel):
+    job_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+class BlobsModel(BaseModel):
+    blob_names: List[str] = Field(max_length=500)
+
+
+class WarmupModel(BaseModel):
+    # More than the class may scale to could never be kept warm
+    containers: int = Field(1, ge=1, le=max_containers)
+    minutes: int = Field(60, ge=1, le=60 * 12)
+    workflow: str = "default"
+
+
+class JobStatus(BaseModel):
+    status: Literal["queued", "running", "done", "failed", "cancelled"]
+    result: Optional[JobResult] = None
+    error: Optional[str] = None
 
 
 with image.imports():
@@ -30,12 +158,31 @@ with image.imports():
 @app.cls(
     gpu=gpu,
     image=image,
-    container_idle_timeout=60 * 10,  # 10 minutes
-    timeout=60 * 2,  # 2 minutes
+    container_idle_timeout=GPU_IDLE_TIMEOUT,
+    timeout=INFER_TIMEOUT,
+    allow_concurrent_inputs=concurrent_inputs,
+    concurrency_limit=max_containers,
     secrets=[modal.Secret.from_name("googlecloud-secret")],
 )
 class ComfyUI:
-    def __init__(self):
+    # Each workflow gets its own containers, which keep its models loaded
+    workflow: str = modal.parameter(default="default")
+
+    @modal.enter()
+    def prepare(self):
+        missing = missing_models(self.workflow)
+        if missing:
+            raise ComfyServerError(
+                f"Workflow {self.workflow} needs missing models: {', '.join(missing)}"
+            )
+
+        # latent2rgb previews are a cheap projection of the latents, so they are
+        # always on and only forwarded for jobs that ask for them
+        self.server = ComfyServer(
+            port=8189, preview_method="latent2rgb", cache_lru=cache_lru
+        )
+        self.server.start()
+
         service_account_info = json.loads(os.environ["SERVICE_ACCOUNT_JSON"])
         cred = credentials.Certificate(service_account_info)
         firebase = initialize_app(
@@ -45,207 +192,1143 @@ class ComfyUI:
         self.bucket = storage.bucket(app=firebase)
         self.db = firestore.client(app=firebase)
 
-        self.workflow_json = json.loads(
-            pathlib.Path("/root/workflow_api.json").read_text()
+        self.workflow_json = load_workflow(self.workflow)
+        self.template = WorkflowTemplate(
+            self.workflow_json, WORKFLOWS[self.workflow]["parameters"]
+        )
+        # The sampler is the node that takes the seed
+        self.sampler_node = self.template.parameters["seed"][0]
+
+        self.events = EventPublisher(job_events)
+        self.records = JobRecords(FirestoreBackend(self.db))
+        self.progress = ProgressWriter(self.records)
+        self.result_cache = ResultCache(
+            self.bucket, {self.workflow: self.workflow_json}
         )
+        self.preprocessed = PreprocessorCache(
+            WORKFLOWS[self.workflow].get("preprocessors", {}),
+            bucket=self.bucket if persist_preprocessed else None,
+        )
+        self.io_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4 * concurrent_inputs
+        )
+        self.task_id = os.environ.get("MODAL_TASK_ID", "local")
+        self._jobs_seen = False
+        self._heartbeat_started = False
+        # Jobs running in this container by job id, watched for cancellation
+        self._active_jobs = {}
+        self.io_pool.submit(self._warm_up)
+        threading.Thread(target=self._watch_cancellations, daemon=True).start()
 
-    def _run_comfyui_server(self, port=8188):
-        cmd = f"python main.py --listen 0.0.0.0 --port {port}"
-        subprocess.Popen(cmd, shell=True)
+    @modal.exit()
+    def shutdown(self):
+        try:
+            warm_containers.pop(self.task_id)
+        except Exception:
+            pass
 
-    @modal.enter()
-    def prepare(self):
-        self._run_comfyui_server(port=8189)
+    def _warm_up(self):
+        """Loads every model of the workflow into VRAM with a 1-step run."""
+        from PIL import Image
 
-    @modal.method()
-    def infer(self, input: InferModel):
-        import urllib
-        import base64
-        import websocket
-        import requests
-        import copy
+        try:
+            self.server.wait_ready()
+
+            # A job that is already queued loads the models just as well
+            if not self._jobs_seen:
+                Image.new("RGB", (1024, 1024), (128, 128, 128)).save(
+                    "/root/input/warmup.png"
+                )
+                values = {"image": "warmup.png"}
+                if "steps" in self.template.parameters:
+                    values["steps"] = 1
+                workflow = self.template.render(**values)
+
+                started_at = time.monotonic()
+                waiter = self.server.queue_prompt(self.template.dumps(workflow))
+                for _ in waiter.events():
+                    pass
+                print(f"Warmup generation took {time.monotonic() - started_at:.2f}s")
+
+            self._start_heartbeat()
+        except Exception as e:
+            print(f"Warmup failed: {e}")
+
+    def _watch_cancellations(self, interval=1.0):
+        """Stops the ComfyUI prompt of every job cancelled through the API."""
+        while True:
+            time.sleep(interval)
+            for job_id, active in list(self._active_jobs.items()):
+                try:
+                    if active["cancelled"] or job_states.get(job_id) != "cancelled":
+                        continue
+                    active["cancelled"] = True
+                    # Otherwise `infer` cancels the prompt right after queueing it
+                    if active["prompt_id"] is not None:
+                        self.server.cancel(active["prompt_id"])
+                except Exception as e:
+                    print(f"Error checking job {job_id} for cancellation: {e}")
+
+    def _start_heartbeat(self):
+        # Also while idle, since that is what a kept-warm container mostly is
+        if self._heartbeat_started:
+            return
+        self._heartbeat_started = True
+        threading.Thread(target=self._heartbeat, daemon=True).start()
 
+    def _heartbeat(self):
         while True:
             try:
-                requests.get("http://0.0.0.0:8189/prompt")
-                break
-            except (requests.ConnectionError, requests.Timeout) as e:
-                continue
-            except:
-                pass
+                warm_containers.put(
+                    self.task_id, {"workflow": self.workflow, "heartbeat": time.time()}
+                )
+            except Exception as e:
+                print(f"Error reporting warm container: {e}")
+            time.sleep(WARM_HEARTBEAT_SECONDS)
+
+    def _stage_input(self, session_id, image=None):
+        """Writes the photo for ComfyUI, returning its hash and stored outputs."""
+        # Photos posted to /job/upload come with the input, so the GPU doesn't
+        # wait on the bucket for them
+        bytes = image
+        if bytes is None:
+            bytes = self.bucket.blob(f"{session_id}/before").download_as_bytes()
+        image_md5 = image_hash(bytes)
+
+        # Named by content, so ComfyUI's cache recognizes a photo it has seen
+        # before whichever session it comes from
+        path = pathlib.Path(f"/root/input/{image_key(image_md5)}")
+        if not path.exists():
+            write_file(path, bytes)
+        return image_md5, self.preprocessed.fetch(image_key(image_md5))
+
+    def _store_preprocessed(self, key, node, output):
+        try:
+            self.preprocessed.store(key, node, output)
+        except Exception as e:
+            print(f"Error storing output of node {node}: {e}")
+
+    def _upload_output(self, blob_name, data, content_type, cache_key):
+        blob = self.bucket.blob(blob_name)
+        blob.upload_from_string(data, content_type=content_type)
 
-        bytes = self.bucket.blob(f"{input.session_id}/before").download_as_bytes()
+        if cache_key is not None:
+            self.bucket.copy_blob(blob, self.bucket, result_blob_name(cache_key))
 
-        pathlib.Path(f"/root/input/{input.session_id}").write_bytes(bytes)
+    @modal.method()
+    def preprocess(self, session_id: str):
+        """Runs the prompt-independent preprocessors on a session's photo.
+
+        Only the nodes the preprocessors' PreviewImage nodes depend on are
+        queued, with the same inputs a job would use, so the job that follows
+        finds their outputs in ComfyUI's cache and in `self.preprocessed`.
+        """
+        ready = self.io_pool.submit(self.server.wait_ready)
+        image_md5, stored = self._stage_input(session_id)
+        key = image_key(image_md5)
 
-        # Create a client-side timestamp as a dictionary
-        now_utc = datetime.datetime.now(datetime.timezone.utc)
-        start_time = {
-            'timestamp': now_utc.timestamp(),
-            'iso': now_utc.isoformat()
+        previews = [
+            preview
+            for preview, node in self.preprocessed.previews.items()
+            if node not in stored
+        ]
+        if previews:
+            workflow = subgraph(self.template.render(image=key), previews)
+            ready.result()
+            waiter = self.server.queue_prompt(self.template.dumps(workflow))
+            for event in waiter.events():
+                data = event["data"]
+                if event["type"] == "executed" and data["node"] in previews:
+                    self._store_preprocessed(key, data["node"], data["output"])
+
+        return {
+            "image": key,
+            "reused": sorted(stored),
+            "computed": sorted(self.preprocessed.previews[p] for p in previews),
         }
 
-        workflow = copy.deepcopy(self.workflow_json)
-        workflow["11"]["inputs"]["seed"] = random.randint(1, 2**64)
-        workflow["1"]["inputs"]["image"] = input.session_id
-        workflow["9"]["inputs"]["text"] += input.prompt
+    @modal.method()
+    def infer(self, input: InferModel, image: Optional[bytes] = None):
+        import base64
+
+        if input.workflow != self.workflow:
+            raise ValueError(
+                f"Job for workflow {input.workflow} sent to {self.workflow} container"
+            )
+        if input.variants > 1 and "batch_size" not in self.template.parameters:
+            raise ValueError(f"Workflow {self.workflow} can't generate variants")
+
+        timings = Timings()
+        job_id = modal.current_function_call_id()
+        self._jobs_seen = True
+        # Never overwrites a "cancelled" the API wrote before the job started
+        claimed = self.io_pool.submit(
+            job_states.put, job_id, "running", skip_if_exists=True
+        )
+        active = {"prompt_id": None, "cancelled": False}
+        self._active_jobs[job_id] = active
 
-        data = json.dumps({"prompt": workflow, "client_id": input.session_id}).encode(
-            "utf-8"
+        # Fetching the input overlaps with the server startup on a cold container
+        ready = timings.submit(self.io_pool, "wait_ready", self.server.wait_ready)
+        staged = timings.submit(
+            self.io_pool, "stage_input", self._stage_input, input.session_id, image
         )
 
-        response = urllib.request.Request(f"http://0.0.0.0:8189/prompt", data=data)
-        result = json.loads(urllib.request.urlopen(response).read())
+        started = None
+        waiter = None
+        generated = False
+        try:
+            ready.result()
+            image_md5, stored = staged.result()
+            key = image_key(image_md5)
+            # A rescheduled input finds its own "running" instead
+            if not claimed.result() and job_states.get(job_id) == "cancelled":
+                raise PromptInterrupted(f"Job {job_id} was cancelled")
+
+            seed = input.seed if input.seed is not None else random.randint(1, MAX_SEED)
+            values = {
+                "seed": seed,
+                "image": key,
+                "prompt": input.prompt,
+            }
+            if input.variants > 1:
+                # Preprocessing and conditioning run once for the whole batch
+                values["batch_size"] = input.variants
+            workflow = self.template.render(**values)
+            # Depth and pose maps computed for this photo before are loaded
+            self.preprocessed.apply(workflow, stored)
 
-        prompt_id = result["prompt_id"]
+            if active["cancelled"]:
+                raise PromptInterrupted(f"Job {job_id} was cancelled")
 
-        doc_ref = self.db.collection("records").document(input.session_id)
+            with timings.stage("queue_prompt"):
+                waiter = self.server.queue_prompt(self.template.dumps(workflow))
+            prompt_id = waiter.prompt_id
+            active["prompt_id"] = prompt_id
+            if active["cancelled"]:
+                self.server.cancel(prompt_id)
 
-        # Get the document
-        doc = doc_ref.get()
-        doc_data = doc.to_dict() if doc.exists else {}
+            # Record the new generation while the GPU works
+            started = timings.submit(
+                self.io_pool,
+                "write_record",
+                self.records.started,
+                input.session_id,
+                prompt_id,
+                input.prompt,
+            )
 
-        # Initialize arrays and count if they don't exist
-        generation_count = doc_data.get('generation_count', 0)
+            encoded_outputs = []
+            with timings.stage("generate"):
+                for event in waiter.events():
+                    data = event["data"]
 
-        # Update the document with new generation info
-        doc_ref.update({
-            "prompt_id": prompt_id,
-            "prompt": input.prompt,
-            "status": "started",
-            "progress": 0,
-            "generation_count": generation_count + 1,  # Increment by 1
-            "generation_start_times": firestore.ArrayUnion([start_time])  # Add new start time
-        }) 
+                    if event["type"] == "executing" and data["node"] is None:
+                        started.result()
+                        self.progress.flush(input.session_id, self.records.executed)
+                        self.events.publish(job_id, "executed")
+
+                    elif event["type"] == "executing":
+                        self.events.publish(job_id, "executing", node=data["node"])
+
+                    elif event["type"] == "executed":
+                        node = self.preprocessed.previews.get(data["node"])
+                        if node is not None and node not in stored:
+                            self.io_pool.submit(
+                                self._store_preprocessed,
+                                key,
+                                data["node"],
+                                data["output"],
+                            )
+
+                    elif event["type"] == "progress":
+                        self.events.publish(
+                            job_id,
+                            "progress",
+                            node=data["node"],
+                            value=data["value"],
+                            max=data["max"],
+                        )
+                        if data["node"] == self.sampler_node:
+                            # Progress must not land before "started" resets it
+                            started.result()
+                            self.progress.update(
+                                input.session_id, data["value"], data["max"]
+                            )
+
+                    elif event["type"] == "image":
+                        node = workflow.get(event["node"], {})
+                        if node.get("class_type") == "SaveImageWebsocket":
+                            # One frame per image of the batch, transcoded off
+                            # the event loop
+                            encoded_outputs.append(
+                                timings.submit(
+                                    self.io_pool,
+                                    variant_stage(
+                                        "transcode",
+                                        len(encoded_outputs),
+                                        input.variants,
+                                    ),
+                                    encode_image,
+                                    data,
+                                    input.output,
+                                )
+                            )
+                        elif input.previews:
+                            preview = base64.b64encode(data).decode()
+                            self.events.publish_preview(
+                                job_id,
+                                node=event["node"],
+                                image=f"data:image/jpeg;base64,{preview}",
+                            )
+            generated = True
+
+            if not encoded_outputs:
+                raise ComfyServerError("The workflow did not send back an image")
+            images_output = [output.result() for output in encoded_outputs]
+
+            content_type = input.output.content_type
+            cache_key = None
+            if input.seed is not None and len(images_output) == 1:
+                cache_key = self.result_cache.key(input, image_md5)
+
+            # A single image keeps the `after` blob booths already read
+            if len(images_output) == 1:
+                blob_names = [f"{input.session_id}/after"]
+            else:
+                blob_names = [
+                    f"{input.session_id}/after/{i}" for i in range(len(images_output))
+                ]
+            uploads = [
+                timings.submit(
+                    self.io_pool,
+                    variant_stage("upload_output", i, len(images_output)),
+                    self._upload_output,
+                    blob_name,
+                    data,
+                    content_type,
+                    cache_key,
+                )
+                for i, (blob_name, data) in enumerate(zip(blob_names, images_output))
+            ]
+
+            variants = [
+                {"blob": blob_name, "size": len(data)}
+                for blob_name, data in zip(blob_names, images_output)
+            ]
+            if input.result_mode == "inline":
+                with timings.stage("encode"):
+                    for variant, data in zip(variants, images_output):
+                        encoded = base64.b64encode(data).decode()
+                        variant["base64_image"] = (
+                            f"data:{content_type};base64,{encoded}"
+                        )
+            result = {**variants[0], "content_type": content_type, "variants": variants}
+
+            with timings.stage("finalize_output"):
+                for upload in uploads:
+                    upload.result()
+                # Only mark the record completed once the images are in the
+                # bucket, since clients fetch them as soon as they see the
+                # status change
+                self.progress.flush(input.session_id, self.records.completed)
+        except BaseException as e:
+            # Interrupted through the API, or the input itself was cancelled
+            cancelled = isinstance(e, PromptInterrupted) or not isinstance(e, Exception)
+            if waiter is not None and not generated and not isinstance(
+                e, ComfyServerError
+            ):
+                # Free the GPU rather than finishing a result nobody waits for
+                try:
+                    self.server.cancel(waiter.prompt_id)
+                except Exception as cancel_error:
+                    print(f"Error cancelling prompt: {cancel_error}")
 
-        ws = websocket.WebSocket()
-        while True:
             try:
-                ws.connect(f"ws://0.0.0.0:8189/ws?clientId={input.session_id}")
-                break
-            except ConnectionRefusedError:
-                time.sleep(1)
+                if started is not None:
+                    started.result()
+                if cancelled:
+                    # Only the generation this job started, if it got that far
+                    self.progress.flush(
+                        input.session_id,
+                        self.records.cancelled,
+                        waiter.prompt_id if started is not None else None,
+                    )
+                else:
+                    self.progress.flush(input.session_id, self.records.failed, str(e))
+            except Exception as record_error:
+                print(f"Error recording failure: {record_error}")
 
-        images_output = None
-        current_node = ""
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-
-                if message["type"] == "executing":
-                    data = message["data"]
-
-                    if data.get("prompt_id") and data.get("prompt_id") == prompt_id:
-                        if data["node"] is None:
-                            doc_ref.update({"status": "executed"})
-                            break
-                        else:
-                            current_node = data["node"]
-
-                elif message["type"] == "progress":
-                    data = message["data"]
-
-                    if (
-                        data.get("prompt_id")
-                        and data.get("prompt_id") == prompt_id
-                        and data["node"] == "11"
-                    ):
-                        doc_ref.update({"progress": data["value"], "status": "pending"})
+            if cancelled:
+                self.events.publish(job_id, "cancelled")
             else:
-                if (
-                    workflow[current_node]
-                    and workflow[current_node]["class_type"] == "SaveImageWebsocket"
-                ):
-                    images_output = out[8:]
+                self.events.publish(job_id, "failed", error=str(e))
+            raise
+        finally:
+            self._active_jobs.pop(job_id, None)
 
-        self.bucket.blob(f"{input.session_id}/after").upload_from_string(
-            images_output, content_type="image/png"
-        )
+        result["timings"] = timings.as_dict()
+        print(f"Job {prompt_id} timings: {json.dumps(result['timings'])}")
 
-        # Create end timestamp in the same format
-        now_utc = datetime.datetime.now(datetime.timezone.utc)
-        end_time = {
-            'timestamp': now_utc.timestamp(),
-            'iso': now_utc.isoformat()
-        }
-        
-        doc_ref.update({
-            "status": "completed",
-            "generation_end_times": firestore.ArrayUnion([end_time])  # Add new end time
-        })
-        result = base64.b64encode(images_output).decode()
+        # Events stay small, so inline images are only part of the result
+        event = {k: v for k, v in result.items() if k != "base64_image"}
+        event["variants"] = [
+            {k: v for k, v in variant.items() if k != "base64_image"}
+            for variant in variants
+        ]
+        self.events.publish(job_id, "completed", **event)
+        self._start_heartbeat()
 
-        return f"data:image/png;base64,{result}"
+        return result
 
 
+# A single API container: the scheduler, idempotency keys and tickets live in
+# its memory. A second container would admit a second round of jobs, and a
+# retry landing on it would spawn a duplicate generation. The app is async,
+# so one container holds plenty of long-polls and streams.
 @app.function(
     gpu=False,
     image=image,
-    allow_concurrent_inputs=100,
+    allow_concurrent_inputs=1000,
+    concurrency_limit=1,
     timeout=60 * 15,
     container_idle_timeout=60 * 15,  # 15 minutes
     secrets=[modal.Secret.from_name("googlecloud-secret")],
 )
 @modal.asgi_app()
 def api():
-    from fastapi import FastAPI, HTTPException
+    import asyncio
+    import collections
+    import contextlib
+    import functools
+    import time
+    import types
+    import uuid
+
+    from fastapi import FastAPI, File, Form, Header, HTTPException, UploadFile
+    from pydantic import ValidationError
     from fastapi.middleware.cors import CORSMiddleware
 
-    fastapi = FastAPI()
+    created_at = time.perf_counter()
+
+    # Filled in by the lifespan hook, so building the app stays cheap
+    clients = types.SimpleNamespace()
+
+    # Blocking GCS, Firestore and signing calls run here, never on the loop
+    blocking_pool = concurrent.futures.ThreadPoolExecutor(max_workers=32)
+
+    async def run_blocking(fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            blocking_pool, functools.partial(fn, *args, **kwargs)
+        )
+
+    def create_clients():
+        service_account_info = json.loads(os.environ["SERVICE_ACCOUNT_JSON"])
+        cred = credentials.Certificate(service_account_info)
+        firebase = initialize_app(
+            cred,
+            options={"storageBucket": "wesmile-photobooth.appspot.com"},
+        )
+        clients.bucket = storage.bucket(app=firebase)
+        clients.records = JobRecords(
+            FirestoreBackend(firestore.client(app=firebase))
+        )
+        clients.signed_urls = SignedUrlCache(clients.bucket)
+        clients.result_cache = ResultCache(
+            clients.bucket, {name: load_workflow(name) for name in WORKFLOWS}
+        )
+
+    @contextlib.asynccontextmanager
+    async def lifespan(_):
+        await run_blocking(create_clients)
+        clients.submitted_jobs = IdempotencyStore()
+        clients.scheduler = FairScheduler(
+            max_in_flight=max_containers * concurrent_inputs,
+            # Room for a full POST /jobs batch from one booth
+            max_queued_per_tenant=MAX_BATCH_JOBS,
+            weights=json.loads(tenant_weights),
+        )
+        clients.tickets = collections.OrderedDict()
+        clients.ticket_writers = set()
+        clients.shutting_down = False
+        # Resolved on first use rather than with a lookup at startup
+        comfyui = modal.Cls.from_name("comfy-api", "ComfyUI")
+        clients.comfyui = {name: comfyui(workflow=name) for name in WORKFLOWS}
+        print(f"API ready {time.perf_counter() - created_at:.2f}s after creation")
+
+        yield
+
+        await fail_queued_jobs()
+        blocking_pool.shutdown(wait=False)
+
+    fastapi = FastAPI(lifespan=lifespan)
     fastapi.add_middleware(
         CORSMiddleware,
         allow_credentials=False,
-        allow_methods=["GET", "POST"],
+        allow_methods=["GET", "POST", "DELETE"],
         allow_headers=["*"],
         allow_origins=["*"],
     )
 
-    service_account_info = json.loads(os.environ["SERVICE_ACCOUNT_JSON"])
-    cred = credentials.Certificate(service_account_info)
-    firebase = initialize_app(
-        cred,
-        options={"storageBucket": "wesmile-photobooth.appspot.com"},
-    )
-    bucket = storage.bucket(app=firebase)
+    @fastapi.get("/blob/{blob_name:path}")
+    async def get_presigned_url(blob_name: str):
+        return await run_blocking(clients.signed_urls.get, blob_name)
 
-    ComfyUI = modal.Cls.lookup("comfy-api", "ComfyUI")
-    comfyui = ComfyUI()
+    @fastapi.post("/blobs")
+    async def get_presigned_urls(input: BlobsModel):
+        names = list(dict.fromkeys(input.blob_names))
+        urls = await asyncio.gather(
+            *(run_blocking(clients.signed_urls.get, name) for name in names)
+        )
+        return dict(zip(names, urls))
 
-    @fastapi.get("/blob/{blob_name:path}")
-    def get_presigned_url(blob_name: str):
-        import datetime
+    @fastapi.get("/stats")
+    async def get_stats():
+        return {
+            "signed_urls": clients.signed_urls.stats(),
+            "idempotent_replays": clients.submitted_jobs.hits,
+            "result_cache": clients.result_cache.stats(),
+            "queue": clients.scheduler.stats(),
+        }
+
+    @fastapi.get("/queue")
+    async def get_queue():
+        return clients.scheduler.stats()
+
+    def reuse_result(input, key, blob):
+        clients.bucket.copy_blob(blob, clients.bucket, f"{input.session_id}/after")
+        clients.records.reused(input.session_id, input.prompt)
+
+        job_id = f"{CACHED_JOB_PREFIX}{key}"
+        job_events.put(
+            {
+                "type": "completed",
+                "blob": blob.name,
+                "size": blob.size,
+                "content_type": blob.content_type,
+                "timings": {},
+                "variants": [{"blob": blob.name, "size": blob.size}],
+            },
+            partition=job_id,
+        )
+        return job_id
+
+    async def spawn_job(input, image=None):
+        if input.workflow not in WORKFLOWS:
+            raise HTTPException(
+                status_code=422, detail=f"Unknown workflow: {input.workflow}"
+            )
+        if (
+            input.variants > 1
+            and "batch_size" not in WORKFLOWS[input.workflow]["parameters"]
+        ):
+            # Caught here rather than after a GPU container has been woken up
+            raise HTTPException(
+                status_code=422,
+                detail=f"Workflow {input.workflow} can't generate variants",
+            )
+
+        # Deterministic requests that were generated before skip the GPU. A
+        # cached job only references its blob, so inline results still run.
+        if (
+            input.seed is not None
+            and input.variants == 1
+            and input.result_mode != "inline"
+        ):
+            image_md5 = image_hash(image) if image is not None else None
+            cached = await run_blocking(clients.result_cache.lookup, input, image_md5)
+            if cached is not None:
+                return await run_blocking(reuse_result, input, *cached)
+
+        try:
+            job = clients.scheduler.submit(
+                input.booth_id or "default",
+                lambda: clients.comfyui[input.workflow].infer.spawn.aio(input, image),
+                lambda job: job.get.aio(),
+                # Cancelled through its ticket while being spawned
+                cancel_call,
+            )
+        except QueueFull as e:
+            raise HTTPException(
+                status_code=429,
+                detail=str(e),
+                headers={"Retry-After": str(e.retry_after)},
+            )
+
+        # With a free slot the job is spawned right away and gets its real id;
+        # otherwise the client gets a ticket instead of a request held open
+        done, _ = await asyncio.wait({job}, timeout=ADMIT_SECONDS)
+        if not done:
+            return await issue_ticket(job)
+        return job.result().object_id
+
+    async def cancel_call(function_call):
+        """Cancels a spawned job and returns whether it had started.
+
+        Modal can't cancel one input of a container running several, and
+        shuts the whole container down instead. So only a job no container
+        has claimed yet is cancelled through Modal. A started job sees its
+        "cancelled" state within a second and stops its own prompt.
+        """
+        job_id = function_call.object_id
+        if await job_states.put.aio(job_id, "cancelled", skip_if_exists=True):
+            # Drops the input if no container picked it up yet
+            await function_call.cancel.aio()
+            return False
+
+        await job_states.put.aio(job_id, "cancelled")
+        return True
+
+    async def issue_ticket(job):
+        now = time.monotonic()
+        while clients.tickets:
+            created_at, _ = next(iter(clients.tickets.values()))
+            if created_at > now - TICKET_TTL:
+                break
+            expired, _ = clients.tickets.popitem(last=False)
+            await queued_jobs.pop.aio(expired, None)
+
+        ticket = f"{QUEUED_JOB_PREFIX}{uuid.uuid4().hex}"
+        await queued_jobs.put.aio(ticket, {"status": "queued"})
+        clients.tickets[ticket] = (now, job)
+
+        writer = asyncio.ensure_future(write_ticket_outcome(ticket, job))
+        clients.ticket_writers.add(writer)
+        writer.add_done_callback(clients.ticket_writers.discard)
+        return ticket
+
+    async def write_ticket_outcome(ticket, job):
+        await asyncio.wait({job})
+        if job.cancelled() and clients.shutting_down:
+            # Polls and event streams of the ticket report this failure
+            outcome = {
+                "status": "failed",
+                "error": "The API restarted before the job could start",
+            }
+        elif job.cancelled():
+            outcome = {"status": "cancelled"}
+        elif job.exception() is not None:
+            outcome = {"status": "failed", "error": str(job.exception())}
+        else:
+            outcome = {"status": "spawned", "job_id": job.result().object_id}
+        await queued_jobs.put.aio(ticket, outcome)
+
+    async def ticket_job(ticket):
+        """The task spawning the job a ticket stands for.
+
+        Tickets of an earlier API container resolve from their stored outcome.
+        """
+        entry = clients.tickets.get(ticket)
+        if entry is not None:
+            return entry[1]
+
+        outcome = await queued_jobs.get.aio(ticket)
+        if outcome is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired job")
+
+        job = asyncio.get_running_loop().create_future()
+        if outcome["status"] == "spawned":
+            job.set_result(modal.functions.FunctionCall.from_id(outcome["job_id"]))
+        elif outcome["status"] == "cancelled":
+            job.cancel()
+        elif outcome["status"] == "failed":
+            job.set_exception(RuntimeError(outcome["error"]))
+        else:
+            # Still queued in a container that went away without failing it
+            job.set_exception(RuntimeError("The job was lost when the API restarted"))
+        return job
+
+    async def fail_queued_jobs():
+        """Fails the jobs still queued when the API container shuts down.
 
-        return bucket.blob(blob_name).generate_signed_url(
-            expiration=datetime.timedelta(minutes=30), method="GET"
+        Jobs being spawned right now finish and stay resolvable.
+        """
+        clients.shutting_down = True
+        clients.scheduler.cancel_queued()
+        if clients.ticket_writers:
+            await asyncio.wait(list(clients.ticket_writers))
+
+    async def submit_job(input, image=None, spawn=None):
+        if spawn is None:
+            spawn = functools.partial(spawn_job, input, image)
+        if input.request_id is None:
+            return await spawn()
+
+        return await clients.submitted_jobs.get_or_spawn(
+            f"{input.session_id}:{input.request_id}", spawn
         )
 
+    def apply_headers(input, idempotency_key, x_booth_id):
+        if idempotency_key is not None and input.request_id is None:
+            input.request_id = idempotency_key
+        if x_booth_id is not None and input.booth_id is None:
+            input.booth_id = x_booth_id
+
     @fastapi.post("/job")
-    def on_job_post(input: InferModel):
-        job = comfyui.infer.spawn(input)
-        return job.object_id
+    async def on_job_post(
+        input: InferModel,
+        idempotency_key: Optional[str] = Header(None),
+        x_booth_id: Optional[str] = Header(None),
+    ):
+        apply_headers(input, idempotency_key, x_booth_id)
+        return await submit_job(input)
 
-    @fastapi.get("/job/{job_id}/{session_id}")
-    def on_get_job(job_id: str, session_id: str):
-        function_call = modal.functions.FunctionCall.from_id(job_id)
+    def upload_input(session_id, data, content_type):
+        clients.bucket.blob(f"{session_id}/before").upload_from_string(
+            data, content_type=content_type
+        )
+
+    async def withdraw_job(job_id):
+        """Cancels a job whose submission failed after it was spawned."""
+        if job_id.startswith(CACHED_JOB_PREFIX):
+            return
+        if job_id.startswith(QUEUED_JOB_PREFIX):
+            ticket = await ticket_job(job_id)
+            if not ticket.done():
+                ticket.cancel()
+                return
+            if ticket.cancelled() or ticket.exception() is not None:
+                return
+            job_id = ticket.result().object_id
+        await cancel_call(modal.functions.FunctionCall.from_id(job_id))
+
+    async def spawn_uploaded_job(input, image, content_type):
+        """Spawns a job while its photo is stored as the session's `before`.
+
+        Later jobs, prepare calls and cache lookups of the session read that
+        blob, so a job whose photo could not be stored is withdrawn.
+        """
+        upload = asyncio.ensure_future(
+            run_blocking(upload_input, input.session_id, image, content_type)
+        )
+        try:
+            job_id = await spawn_job(input, image)
+        except BaseException:
+            # The photo is still worth keeping for a retry
+            await asyncio.wait({upload})
+            raise
+
+        try:
+            await upload
+        except Exception as e:
+            print(f"Error uploading input of session {input.session_id}: {e}")
+            await withdraw_job(job_id)
+            raise HTTPException(status_code=502, detail="Could not store the photo")
+        return job_id
+
+    @fastapi.post("/job/upload")
+    async def on_job_upload(
+        image: UploadFile = File(...),
+        job: str = Form(...),
+        idempotency_key: Optional[str] = Header(None),
+        x_booth_id: Optional[str] = Header(None),
+    ):
+        """Submits a job together with its photo, in one multipart request.
+
+        The photo travels to the GPU container with the job, and is stored as
+        the session's `before` blob while the job is spawned. The request
+        fails with 502 if it can't be stored.
+        """
         try:
-            # Get the base64 result
-            base64_result = function_call.get(timeout=60)
+            input = InferModel.model_validate_json(job)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=json.loads(e.json()))
+        apply_headers(input, idempotency_key, x_booth_id)
 
-            # Generate signed URL using the provided session_id
-            signed_url = bucket.blob(f"{session_id}/after").generate_signed_url(
-                expiration=datetime.timedelta(minutes=30), method="GET"
+        data = await image.read(MAX_UPLOAD_BYTES + 1)
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Images are limited to {MAX_UPLOAD_BYTES} bytes",
             )
 
-            # Return both results
-            return JobResult(base64_image=base64_result, signed_url=signed_url)
+        return await submit_job(
+            input,
+            spawn=functools.partial(
+                spawn_uploaded_job, input, data, image.content_type
+            ),
+        )
+
+    @fastapi.post("/session/{session_id}/prepare")
+    async def on_session_prepare(session_id: str, workflow: str = "default"):
+        """Preprocesses a session's photo while the guest picks a prompt."""
+        if workflow not in WORKFLOWS:
+            raise HTTPException(status_code=422, detail=f"Unknown workflow: {workflow}")
+
+        # Speculative work never takes a GPU slot a queued job could use, and
+        # holds its slot while it runs so jobs don't count on it either
+        call = await clients.scheduler.spawn_if_idle(
+            lambda: clients.comfyui[workflow].preprocess.spawn.aio(session_id),
+            lambda call: call.get.aio(),
+        )
+        if call is None:
+            return {"job_id": None, "status": "skipped"}
+        return {"job_id": call.object_id, "status": "started"}
+
+    def format_event(event):
+        return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    async def finished_event(job_id):
+        """The terminal event of a job that has ended, or None while it runs."""
+        job = await poll_job(job_id, 0)
+        if job.status == "done":
+            # Like the published event, without inline images
+            result = job.result.model_dump(
+                exclude={
+                    "base64_image": True,
+                    "variants": {"__all__": {"base64_image"}},
+                }
+            )
+            return {"type": "completed", **result}
+        if job.status == "failed":
+            return {"type": "failed", "error": job.error}
+        if job.status == "cancelled":
+            return {"type": "cancelled"}
+        return None
+
+    @fastapi.get("/events/{job_id}")
+    async def on_job_events(job_id: str):
+        from fastapi.responses import StreamingResponse
+
+        ticket = None
+        if job_id.startswith(QUEUED_JOB_PREFIX):
+            ticket = await ticket_job(job_id)
+
+        # Server-sent events, relayed from the job's partition of the event
+        # queue. Each event is delivered once, so one stream per job.
+        async def stream():
+            nonlocal job_id
+            if ticket is not None:
+                while not ticket.done():
+                    await asyncio.wait({ticket}, timeout=15)
+                    if not ticket.done():
+                        yield ": keep-alive\n\n"
+                if ticket.cancelled():
+                    yield format_event({"type": "cancelled"})
+                    return
+                if ticket.exception() is not None:
+                    yield format_event(
+                        {"type": "failed", "error": str(ticket.exception())}
+                    )
+                    return
+                job_id = ticket.result().object_id
+
+            while True:
+                events = await job_events.get_many.aio(
+                    100, partition=job_id, timeout=15
+                )
+                if not events:
+                    # A job that crashed or timed out never publishes a
+                    # terminal event, so ask Modal how it ended
+                    outcome = await finished_event(job_id)
+                    if outcome is None:
+                        yield ": keep-alive\n\n"
+                        continue
+                    # Events sent right before the job returned may still be
+                    # on their way
+                    events = await job_events.get_many.aio(
+                        100, partition=job_id, timeout=2
+                    )
+                    events.append(outcome)
+
+                for event in events:
+                    yield format_event(event)
+                    if event["type"] in TERMINAL_EVENTS:
+                        return
+
+        return StreamingResponse(
+            stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @fastapi.post("/jobs")
+    async def on_jobs_post(
+        inputs: List[InferModel], x_booth_id: Optional[str] = Header(None)
+    ):
+        if len(inputs) > MAX_BATCH_JOBS:
+            raise HTTPException(
+                status_code=413, detail=f"At most {MAX_BATCH_JOBS} jobs per request"
+            )
+        for input in inputs:
+            apply_headers(input, None, x_booth_id)
+
+        job_ids = await asyncio.gather(
+            *(submit_job(input) for input in inputs),
+            return_exceptions=True,
+        )
+
+        submissions = []
+        for job_id in job_ids:
+            if isinstance(job_id, Exception):
+                print(f"Error spawning job: {str(job_id)}")
+                submissions.append(JobSubmission(error=str(job_id)))
+            else:
+                submissions.append(JobSubmission(job_id=job_id))
+        return submissions
+
+    async def poll_cached_job(job_id):
+        key = job_id[len(CACHED_JOB_PREFIX):]
+        blob = await run_blocking(clients.bucket.get_blob, result_blob_name(key))
+        if blob is None:
+            return JobStatus(status="failed", error="Cached result no longer exists")
+
+        signed_url = await run_blocking(clients.signed_urls.get, blob.name)
+        result = JobResult(
+            signed_url=signed_url,
+            blob=blob.name,
+            size=blob.size,
+            content_type=blob.content_type,
+            variants=[JobImage(signed_url=signed_url, blob=blob.name, size=blob.size)],
+        )
+        return JobStatus(status="done", result=result)
+
+    async def poll_job(job_id, wait):
+        if job_id.startswith(CACHED_JOB_PREFIX):
+            return await poll_cached_job(job_id)
+
+        if job_id.startswith(QUEUED_JOB_PREFIX):
+            ticket = await ticket_job(job_id)
+            started_at = time.monotonic()
+            await asyncio.wait({ticket}, timeout=min(max(wait, 0), MAX_POLL_SECONDS))
+            if not ticket.done():
+                return JobStatus(status="queued")
+            if ticket.cancelled():
+                return JobStatus(status="cancelled")
+            if ticket.exception() is not None:
+                return JobStatus(status="failed", error=str(ticket.exception()))
+            job_id = ticket.result().object_id
+            wait -= time.monotonic() - started_at
 
+        function_call = modal.functions.FunctionCall.from_id(job_id)
+        try:
+            result = await function_call.get.aio(
+                timeout=min(max(wait, 0), MAX_POLL_SECONDS)
+            )
         except TimeoutError:
-            raise HTTPException(status_code=425, detail="Job is still processing")
+            state = await job_states.get.aio(job_id)
+            if state == "cancelled":
+                return JobStatus(status="cancelled")
+            return JobStatus(status="running" if state == "running" else "queued")
         except Exception as e:
+            if await job_states.get.aio(job_id) == "cancelled":
+                return JobStatus(status="cancelled")
             print(f"Error processing job {job_id}: {str(e)}")
+            return JobStatus(status="failed", error=str(e))
+
+        variants = result.get("variants", [result])
+        signed_urls = await asyncio.gather(
+            *(run_blocking(clients.signed_urls.get, v["blob"]) for v in variants)
+        )
+        result["variants"] = [
+            JobImage(**{**variant, "signed_url": signed_url})
+            for variant, signed_url in zip(variants, signed_urls)
+        ]
+        return JobStatus(
+            status="done", result=JobResult(signed_url=signed_urls[0], **result)
+        )
+
+    async def get_job_result(job_id, wait):
+        job = await poll_job(job_id, wait)
+        if job.status == "failed":
             raise HTTPException(
-                status_code=500, detail=f"Error processing job: {str(e)}"
+                status_code=500, detail=f"Error processing job: {job.error}"
             )
+        if job.status == "cancelled":
+            raise HTTPException(status_code=409, detail="Job was cancelled")
+        if job.status != "done":
+            raise HTTPException(status_code=425, detail=f"Job is {job.status}")
+        return job.result
+
+    async def warmup_status():
+        window = await warmup_window.get.aio("window")
+        workflow = window.get("workflow", "default") if window else "default"
+
+        # Containers remove themselves on exit; a missed heartbeat covers
+        # the ones that crashed
+        fresh_after = time.time() - 3 * WARM_HEARTBEAT_SECONDS
+        warm_by_workflow = {}
+        async for _, container in warm_containers.items.aio():
+            if isinstance(container, dict) and container["heartbeat"] > fresh_after:
+                name = container["workflow"]
+                warm_by_workflow[name] = warm_by_workflow.get(name, 0) + 1
+
+        return {
+            "requested": window["containers"] if window else 0,
+            "until": window["until"] if window else None,
+            "workflow": workflow if window else None,
+            "warm": warm_by_workflow.get(workflow, 0),
+            "warm_by_workflow": warm_by_workflow,
+        }
+
+    @fastapi.post("/warmup")
+    async def on_warmup_post(input: WarmupModel):
+        if input.workflow not in WORKFLOWS:
+            raise HTTPException(
+                status_code=422, detail=f"Unknown workflow: {input.workflow}"
+            )
+
+        # Only one window at a time, so scale down whatever the last one kept
+        window = await warmup_window.get.aio("window")
+        if window is not None and window.get("workflow") != input.workflow:
+            workflow = window.get("workflow", "default")
+            await clients.comfyui[workflow].infer.keep_warm.aio(0)
+
+        # Each new container runs a warmup generation in `prepare`
+        await clients.comfyui[input.workflow].infer.keep_warm.aio(input.containers)
+        await warmup_window.put.aio(
+            "window",
+            {
+                "containers": input.containers,
+                "until": time.time() + input.minutes * 60,
+                "workflow": input.workflow,
+            },
+        )
+        return await warmup_status()
+
+    @fastapi.delete("/warmup")
+    async def on_warmup_delete():
+        window = await warmup_window.get.aio("window")
+        workflow = window.get("workflow", "default") if window else "default"
+        await clients.comfyui[workflow].infer.keep_warm.aio(0)
+        try:
+            await warmup_window.pop.aio("window")
+        except KeyError:
+            pass
+        return await warmup_status()
+
+    @fastapi.get("/warmup")
+    async def on_get_warmup():
+        return await warmup_status()
+
+    @fastapi.get("/status/{job_id}")
+    async def on_get_job_status(job_id: str, wait: float = 0):
+        return await poll_job(job_id, wait)
+
+    @fastapi.delete("/job/{job_id}")
+    async def on_job_delete(job_id: str, session_id: Optional[str] = None):
+        if job_id.startswith(CACHED_JOB_PREFIX):
+            raise HTTPException(
+                status_code=409, detail="Cached results can't be cancelled"
+            )
+
+        if job_id.startswith(QUEUED_JOB_PREFIX):
+            ticket = await ticket_job(job_id)
+            if not ticket.done():
+                # Still in the API's queue, so no GPU or record is involved. A
+                # job spawned meanwhile is cancelled once its id is known.
+                ticket.cancel()
+                return {"job_id": job_id, "status": "cancelled"}
+            if ticket.cancelled() or ticket.exception() is not None:
+                raise HTTPException(status_code=409, detail="Job never started")
+            job_id = ticket.result().object_id
+
+        function_call = modal.functions.FunctionCall.from_id(job_id)
+        try:
+            await function_call.get.aio(timeout=0)
+            finished = True
+        except TimeoutError:
+            finished = False
+        except Exception:
+            finished = True
+        if finished:
+            raise HTTPException(status_code=409, detail="Job already finished")
+
+        started = await cancel_call(function_call)
+        # A started job's container updates the record itself, since only it
+        # knows whether the session has moved on to a newer generation
+        if session_id is not None and not started:
+            await run_blocking(clients.records.cancelled, session_id)
+        return {"job_id": job_id, "status": "cancelled"}
+
+    @fastapi.get("/job/{job_id}/{session_id}")
+    async def on_get_job(job_id: str, session_id: str, wait: float = 0):
+        return await get_job_result(job_id, wait)
+
+    @fastapi.get("/job/{job_id}/{session_id}/image")
+    async def on_get_job_image(
+        job_id: str, session_id: str, wait: float = 0, variant: int = 0
+    ):
+        from fastapi.responses import StreamingResponse
+
+        result = await get_job_result(job_id, wait)
+        if not 0 <= variant < len(result.variants):
+            raise HTTPException(status_code=404, detail=f"No variant {variant}")
+        blob_name = result.variants[variant].blob
+
+        # Stream the uploaded output straight from the bucket in chunks
+        async def chunks():
+            reader = await run_blocking(clients.bucket.blob(blob_name).open, "rb")
+            try:
+                while chunk := await run_blocking(reader.read, 256 * 1024):
+                    yield chunk
+            finally:
+                await run_blocking(reader.close)
+
+        return StreamingResponse(chunks(), media_type=result.content_type)
+
+    return fastapi
+
+
+@app.function(image=image, schedule=modal.Period(minutes=5))
+def expire_warmup():
+    """Scales the ComfyUI containers back down once a warmup window is over."""
+    window = warmup_window.get("window")
+    if window is not None and window["until"] < time.time():
+        workflow = window.get("workflow", "default")
+        comfyui = modal.Cls.from_name("comfy-api", "ComfyUI")
+        comfyui(workflow=workflow).infer.keep_warm(0)
+        warmup_window.pop("window")
+
+
+@app.local_entrypoint()
+def benchmark_concurrency(jobs: int = 24, concurrency: int = concurrent_inputs):
+    from .benchmarks import benchmark_concurrency
+
+    benchmark_concurrency(jobs=jobs, concurrency=concurrency)
+
+
+@app.local_entrypoint()
+def benchmark_encoding(image: str, uplink_mbps: float = 50.0):
+    from .benchmarks import benchmark_encoding
+
+    benchmark_encoding(pathlib.Path(image).read_bytes(), uplink_mbps=uplink_mbps)
+
+
+@app.local_entrypoint()
+def benchmark_signing(requests: int = 2000, blobs: int = 50):
+    from .benchmarks import benchmark_signing
+
+    benchmark_signing(requests=requests, blobs=blobs)
+
+
+@app.local_entrypoint()
+def benchmark_workflow(iterations: int = 2000):
+    from .benchmarks import benchmark_workflow
+
+    workflow = load_workflow("default", pathlib.Path(__file__).parent)
+    benchmark_workflow(workflow, iterations=iterations)
+
+
+@app.local_entrypoint()
+def benchmark_variants(
+    session_id: str, image: str, prompt: str = "", variants: int = 4
+):
+    from .benchmarks import benchmark_variants
+
+    benchmark_variants(
+        ComfyUI().infer.remote,
+        lambda n: InferModel(session_id=session_id, prompt=prompt, variants=n),
+        pathlib.Path(image).read_bytes(),
+        variants=variants,
+    )
+
+
+@app.local_entrypoint()
+def benchmark_api(
+    url: str, path: str = "/stats", requests: int = 2000, concurrency: int = 200
+):
+    from .benchmarks import benchmark_api
 
-    return fastapi
\ No newline at end of file
+    benchmark_api(url, path=path, requests=requests, concurrency=concurrency)
@@ -0,0 +1,341 @@
+import concurrent.futures
+import datetime
+import itertools
+import json
+import queue
+import threading
+import time
+
+from .encoding import OutputEncoding, encode_image
+from .server import ComfyServer
+from .signing import SignedUrlCache
+from .workflows import WorkflowTemplate
+
+
+class FakeComfyServer(ComfyServer):
+    """ComfyUI stand-in that runs prompts on a single simulated GPU.
+
+    Prompts are executed one at a time in queue order, like the real server,
+    and their events are fed through the real dispatcher so the benchmark
+    exercises the same routing code as production.
+    """
+
+    def __init__(self, gpu_seconds=6.0, steps=25):
+        super().__init__()
+        self.gpu_seconds = gpu_seconds
+        self.steps = steps
+        self.busy_seconds = 0.0
+        self._prompts = queue.Queue()
+        self._ids = itertools.count()
+
+    def start(self):
+        threading.Thread(target=self._run_gpu, daemon=True).start()
+        self._ready.set()
+
+    def wait_ready(self, timeout=None):
+        pass
+
+    def queue_prompt(self, workflow):
+        prompt_id = f"prompt-{next(self._ids)}"
+        waiter = self._register(prompt_id)
+        self._prompts.put(prompt_id)
+        return waiter
+
+    def _send(self, type, data):
+        self._dispatch(json.dumps({"type": type, "data": data}))
+
+    def _run_gpu(self):
+        while True:
+            prompt_id = self._prompts.get()
+            started_at = time.monotonic()
+
+            self._send("executing", {"node": "11", "prompt_id": prompt_id})
+            for step in range(1, self.steps + 1):
+                time.sleep(self.gpu_seconds / self.steps)
+                self._send(
+                    "progress",
+                    {
+                        "node": "11",
+                        "value": step,
+                        "max": self.steps,
+                        "prompt_id": prompt_id,
+                    },
+                )
+            self._send("executing", {"node": "74", "prompt_id": prompt_id})
+            self._dispatch(b"\0" * 8 + b"fake image")
+            self._send("executing", {"node": None, "prompt_id": prompt_id})
+
+            self.busy_seconds += time.monotonic() - started_at
+
+
+def benchmark_concurrency(
+    jobs=24,
+    concurrency=3,
+    gpu_seconds=6.0,
+    staging_seconds=1.5,
+    finalize_seconds=2.5,
+):
+    """Compares jobs/min with one input per container against `concurrency`.
+
+    Staging stands in for the `before` download and Firestore setup, and
+    finalization for the GCS upload, Firestore update and base64 encoding.
+    """
+
+    def run(server):
+        time.sleep(staging_seconds)
+        waiter = server.queue_prompt({})
+        for _ in waiter.events():
+            pass
+        time.sleep(finalize_seconds)
+
+    results = {}
+    for workers in sorted({1, concurrency}):
+        server = FakeComfyServer(gpu_seconds=gpu_seconds)
+        server.start()
+
+        started_at = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda _: run(server), range(jobs)))
+        elapsed = time.monotonic() - started_at
+
+        jobs_per_minute = jobs / elapsed * 60
+        gpu_utilization = server.busy_seconds / elapsed
+        results[workers] = {
+            "jobs_per_minute": jobs_per_minute,
+            "gpu_utilization": gpu_utilization,
+        }
+        print(
+            f"concurrent inputs={workers}: {jobs_per_minute:.1f} jobs/min, "
+            f"GPU busy {gpu_utilization:.0%}"
+        )
+
+    gain = results[concurrency]["jobs_per_minute"] / results[1]["jobs_per_minute"]
+    print(f"throughput gain: {gain:.2f}x")
+    return results
+
+
+ENCODINGS = {
+    "png (as sent)": OutputEncoding(),
+    "png level 9": OutputEncoding(compress_level=9),
+    "webp q90": OutputEncoding(format="webp", quality=90),
+    "webp q80": OutputEncoding(format="webp", quality=80),
+    "jpeg q90": OutputEncoding(format="jpeg", quality=90),
+    "webp q85 1024px": OutputEncoding(format="webp", quality=85, max_dimension=1024),
+}
+
+
+def benchmark_encoding(png_bytes, uplink_mbps=50.0, encodings=ENCODINGS):
+    """Output size, transcode time and estimated upload time per encoding.
+
+    `png_bytes` should be a PNG as sent by SaveImageWebsocket; the upload time
+    assumes the container's uplink to GCS runs at `uplink_mbps`.
+    """
+    baseline = len(png_bytes)
+    results = {}
+    for name, encoding in encodings.items():
+        started_at = time.perf_counter()
+        encoded = encode_image(png_bytes, encoding)
+        transcode_seconds = time.perf_counter() - started_at
+        upload_seconds = len(encoded) * 8 / (uplink_mbps * 1_000_000)
+        saved_seconds = (baseline - len(encoded)) * 8 / (uplink_mbps * 1_000_000)
+
+        results[name] = {
+            "bytes": len(encoded),
+            "transcode_seconds": transcode_seconds,
+            "upload_seconds": upload_seconds,
+        }
+        print(
+            f"{name:>18}: {len(encoded) / 1024:8.1f} KiB "
+            f"({1 - len(encoded) / baseline:6.1%} saved), "
+            f"transcode {transcode_seconds * 1000:6.1f} ms, "
+            f"upload {upload_seconds * 1000:6.1f} ms "
+            f"(net saving {(saved_seconds - transcode_seconds) * 1000:+.1f} ms)"
+        )
+
+    return results
+
+
+def benchmark_signing(requests=2000, blobs=50):
+    """Signed URLs per second with and without `SignedUrlCache`.
+
+    Signs with a throwaway service account key, so no credentials or network
+    are needed. Requests cycle over `blobs` names, like booths polling the
+    `before`/`after` URLs of a handful of sessions.
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from google.cloud import storage
+    from google.oauth2 import service_account
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    credentials = service_account.Credentials.from_service_account_info({
+        "type": "service_account",
+        "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+        "private_key": private_key,
+        "token_uri": "https://oauth2.googleapis.com/token",
+    })
+    bucket = storage.Client(project="benchmark", credentials=credentials).bucket(
+        "benchmark"
+    )
+    names = [
+        f"session-{i % blobs}/{'after' if i % 2 else 'before'}"
+        for i in range(requests)
+    ]
+
+    started_at = time.perf_counter()
+    for name in names:
+        bucket.blob(name).generate_signed_url(
+            expiration=datetime.timedelta(minutes=30), method="GET"
+        )
+    uncached = requests / (time.perf_counter() - started_at)
+
+    cache = SignedUrlCache(bucket)
+    started_at = time.perf_counter()
+    for name in names:
+        cache.get(name)
+    cached = requests / (time.perf_counter() - started_at)
+
+    print(f"uncached: {uncached:,.0f} URLs/s")
+    print(f"  cached: {cached:,.0f} URLs/s ({cache.stats()['hit_rate']:.1%} hits)")
+    print(f" speedup: {cached / uncached:.1f}x")
+    return {"uncached": uncached, "cached": cached, **cache.stats()}
+
+
+def benchmark_api(url, path="/stats", requests=2000, concurrency=200):
+    """Load-tests a deployed API endpoint.
+
+    The first request is sent on its own, so against a scaled-down app its
+    latency is the container's cold start. The rest are sent `concurrency` at
+    a time to find how many requests one container sustains.
+    """
+    import asyncio
+
+    import httpx
+
+    async def run():
+        limits = httpx.Limits(max_connections=concurrency)
+        client = httpx.AsyncClient(base_url=url, timeout=120, limits=limits)
+        async with client:
+            started_at = time.perf_counter()
+            await client.get(path)
+            first_response = time.perf_counter() - started_at
+
+            latencies = []
+            errors = 0
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def request():
+                nonlocal errors
+                async with semaphore:
+                    started_at = time.perf_counter()
+                    try:
+                        response = await client.get(path)
+                        if response.status_code >= 500:
+                            errors += 1
+                    except httpx.HTTPError:
+                        errors += 1
+                    latencies.append(time.perf_counter() - started_at)
+
+            started_at = time.perf_counter()
+            await asyncio.gather(*(request() for _ in range(requests)))
+            elapsed = time.perf_counter() - started_at
+
+        return first_response, sorted(latencies), errors, elapsed
+
+    first_response, latencies, errors, elapsed = asyncio.run(run())
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+
+    print(f"first response: {first_response:.2f}s")
+    print(
+        f"{requests} requests at concurrency {concurrency}: "
+        f"{requests / elapsed:.0f} req/s, p50 {p50 * 1000:.0f} ms, "
+        f"p99 {p99 * 1000:.0f} ms, {errors} errors"
+    )
+    return {
+        "first_response": first_response,
+        "requests_per_second": requests / elapsed,
+        "p50": p50,
+        "p99": p99,
+        "errors": errors,
+    }
+
+
+def benchmark_workflow(workflow, iterations=2000):
+    """Per-request cost of building the `/prompt` payload of a workflow.
+
+    Compares deep-copying and patching the whole graph, then serializing it,
+    with rendering and serializing a precompiled `WorkflowTemplate`.
+    """
+    import copy
+
+    def deepcopy_path(i):
+        graph = copy.deepcopy(workflow)
+        graph["11"]["inputs"]["seed"] = i
+        graph["1"]["inputs"]["image"] = f"session-{i}"
+        graph["9"]["inputs"]["text"] += "a portrait in the style of a comic"
+        return json.dumps(graph)
+
+    template = WorkflowTemplate(workflow)
+
+    def template_path(i):
+        graph = template.render(
+            seed=i, image=f"session-{i}", prompt="a portrait in the style of a comic"
+        )
+        return template.dumps(graph)
+
+    if json.loads(deepcopy_path(0)) != json.loads(template_path(0)):
+        raise AssertionError("The template renders a different graph")
+
+    results = {}
+    for name, build in (("deepcopy", deepcopy_path), ("template", template_path)):
+        started_at = time.perf_counter()
+        for i in range(iterations):
+            build(i)
+        results[name] = (time.perf_counter() - started_at) / iterations
+        print(f"{name:>8}: {results[name] * 1_000_000:8.1f} µs per request")
+
+    print(f" speedup: {results['deepcopy'] / results['template']:.1f}x")
+    return results
+
+
+def distinct_photo(photo, i):
+    """`photo` with `i` appended after its image data, which decoders ignore.
+
+    The bytes differ, so the photo is stored under a new hash and no cache
+    of ComfyUI or the preprocessors recognizes it.
+    """
+    return photo + f"benchmark-{i}".encode()
+
+
+def benchmark_variants(infer, make_input, photo, variants=4):
+    """Seconds per image of one job with `variants` images vs single jobs.
+
+    `infer(input, image)` runs a job on a GPU container and returns its
+    result, and `make_input(n)` builds the input of a job with `n` variants.
+    Jobs run one at a time on a container warmed up by a first job, so the
+    difference is the preprocessing and conditioning a batch only pays for
+    once. Every job gets its own copy of `photo`, so none of them reuses
+    another's preprocessing.
+    """
+    photos = (distinct_photo(photo, i) for i in itertools.count())
+    infer(make_input(1), next(photos))
+
+    started_at = time.perf_counter()
+    result = infer(make_input(variants), next(photos))
+    batched = (time.perf_counter() - started_at) / len(result["variants"])
+
+    started_at = time.perf_counter()
+    for _ in range(variants):
+        infer(make_input(1), next(photos))
+    separate = (time.perf_counter() - started_at) / variants
+
+    print(f"{f'{variants} separate jobs':>18}: {separate:.2f}s per image")
+    print(f"{f'1 job, {variants} variants':>18}: {batched:.2f}s per image")
+    print(f"{'speedup':>18}: {separate / batched:.2f}x")
+    return {"separate": separate, "batched": batched}
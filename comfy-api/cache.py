@@ -0,0 +1,93 @@
+import base64
+import hashlib
+import json
+import threading
+
+# Job ids handed out for cache hits, which never reach a GPU container
+CACHED_JOB_PREFIX = "cached-"
+
+
+def image_hash(data):
+    """Base64 MD5 of an image, the same digest GCS reports as `md5_hash`."""
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def image_key(image_md5):
+    """Hex form of an `image_hash`, safe in file and blob names."""
+    return base64.b64decode(image_md5).hex()
+
+
+def result_key(image_md5, prompt, seed, workflow, output):
+    payload = json.dumps(
+        {
+            "image": image_md5,
+            "prompt": prompt,
+            "seed": seed,
+            "workflow": workflow,
+            "output": output,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def result_blob_name(key):
+    return f"results/{key}"
+
+
+class ResultCache:
+    """Outputs of deterministic generations, content-addressed in the bucket.
+
+    With a fixed seed the output only depends on the input image, the prompt,
+    the seed, the workflow and the output encoding, so a request that hashes
+    to an existing `results/{key}` blob can reuse it without touching a GPU.
+    `workflows` maps the names jobs select to their graphs.
+    """
+
+    def __init__(self, bucket, workflows):
+        self.bucket = bucket
+        self.workflows = workflows
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, input, image_md5):
+        return result_key(
+            image_md5,
+            input.prompt,
+            input.seed,
+            self.workflows[input.workflow],
+            input.output.model_dump(),
+        )
+
+    def lookup(self, input, image_md5=None):
+        """Returns `(key, blob)` of a cached result for `input`, or None.
+
+        Without `image_md5` the hash of the session's `before` blob is used.
+        """
+        if image_md5 is None:
+            before = self.bucket.get_blob(f"{input.session_id}/before")
+            image_md5 = before.md5_hash if before is not None else None
+
+        cached = None
+        if image_md5 is not None:
+            key = self.key(input, image_md5)
+            blob = self.bucket.get_blob(result_blob_name(key))
+            if blob is not None:
+                cached = (key, blob)
+
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return cached
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
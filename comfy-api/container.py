@@ -1,11 +1,27 @@
 from modal import Image
 import pathlib
+import os
 
 from .models import download_checkpoints
 from .nodes import download_nodes
+from .workflows import WORKFLOW_DIR, WORKFLOWS
 
 commit_sha = "2a02546e2085487d34920e5b5c9b367918531f32"
 gpu = "h100"
+# Inputs a single GPU container accepts at once. Extra inputs are staged and
+# finalized while ComfyUI's own queue keeps the GPU busy; 1 disables overlap.
+concurrent_inputs = int(os.environ.get("COMFYUI_CONCURRENT_INPUTS", 3))
+# Most GPU containers running at once; the API admits at most
+# max_containers * concurrent_inputs jobs and queues the rest per booth.
+max_containers = int(os.environ.get("COMFYUI_MAX_CONTAINERS", 5))
+# Share of the GPUs each booth gets while others are waiting, e.g.
+# '{"main-stage": 2}'. Booths not listed get a weight of 1.
+tenant_weights = os.environ.get("COMFYUI_TENANT_WEIGHTS", "{}")
+# Node outputs ComfyUI keeps in memory across prompts, so a regeneration on
+# the same photo skips the image-only nodes; 0 keeps only the last prompt's.
+cache_lru = int(os.environ.get("COMFYUI_CACHE_LRU", 100))
+# Also store preprocessor outputs in the bucket, for other containers to reuse
+persist_preprocessed = os.environ.get("COMFYUI_PERSIST_PREPROCESSED", "1") == "1"
 
 # Define the image with correct configuration
 image = (
@@ -28,6 +44,7 @@ image = (
         "gdown",
         "websocket-client",
         "firebase_admin",
+        "python-multipart",
     )
     .run_function(download_nodes, gpu=gpu)
     .run_function(download_checkpoints)
@@ -36,8 +53,21 @@ image = (
         "cd /root/models/insightface && gdown https://drive.google.com/uc?id=1qXsQJ8ZT42_xSmWIYy85IcidpiZudOCB -O buffalo_l.zip",
         "cd /root/models/insightface && unzip buffalo_l.zip -d models",
     )
-    .add_local_file(
-        local_path=str(pathlib.Path(__file__).parent / "workflow_api.json"),
-        remote_path="/root/workflow_api.json"
+    # Bake the deploy-time settings in, so containers read the same values
+    .env(
+        {
+            "COMFYUI_CONCURRENT_INPUTS": str(concurrent_inputs),
+            "COMFYUI_MAX_CONTAINERS": str(max_containers),
+            "COMFYUI_TENANT_WEIGHTS": tenant_weights,
+            "COMFYUI_CACHE_LRU": str(cache_lru),
+            "COMFYUI_PERSIST_PREPROCESSED": "1" if persist_preprocessed else "0",
+        }
     )
-)
\ No newline at end of file
+)
+
+# Workflow files go last, so editing one doesn't rebuild the layers above
+for workflow in WORKFLOWS.values():
+    image = image.add_local_file(
+        local_path=str(pathlib.Path(__file__).parent / workflow["file"]),
+        remote_path=f"{WORKFLOW_DIR}/{workflow['file']}",
+    )
\ No newline at end of file
@@ -0,0 +1,64 @@
+import io
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+
+
+class OutputEncoding(BaseModel):
+    format: Literal["png", "webp", "jpeg"] = "png"
+    # Used by webp and jpeg
+    quality: int = Field(90, ge=1, le=100)
+    # Used by png; None keeps the bytes ComfyUI produced untouched
+    compress_level: Optional[int] = Field(None, ge=0, le=9)
+    # Longest side of the output, None keeps the generated size
+    max_dimension: Optional[int] = Field(None, ge=64)
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.format]
+
+    @property
+    def passthrough(self):
+        return (
+            self.format == "png"
+            and self.compress_level is None
+            and self.max_dimension is None
+        )
+
+
+DEFAULT_OUTPUT_ENCODING = OutputEncoding()
+
+
+def encode_image(png_bytes, encoding):
+    """Transcodes the PNG sent by SaveImageWebsocket to `encoding`."""
+    if encoding.passthrough:
+        return png_bytes
+
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(png_bytes))
+    if encoding.max_dimension is not None:
+        image.thumbnail(
+            (encoding.max_dimension, encoding.max_dimension), Image.LANCZOS
+        )
+
+    output = io.BytesIO()
+    if encoding.format == "jpeg":
+        image.convert("RGB").save(
+            output, "JPEG", quality=encoding.quality, optimize=True
+        )
+    elif encoding.format == "webp":
+        image.save(output, "WEBP", quality=encoding.quality, method=4)
+    else:
+        compress_level = encoding.compress_level
+        if compress_level is None:
+            compress_level = 6
+        image.save(output, "PNG", compress_level=compress_level)
+
+    return output.getvalue()
@@ -0,0 +1,53 @@
+import threading
+
+# Events that end a job's stream
+TERMINAL_EVENTS = ("completed", "failed", "cancelled")
+
+
+class EventPublisher:
+    """Pushes live job events to a `modal.Queue`, one partition per job.
+
+    Events are buffered locally and sent in batches from a background thread,
+    so publishing never waits on the network. Previews are lossy: only the
+    most recent one per job is kept while a batch is in flight.
+    """
+
+    def __init__(self, queue, partition_ttl=60 * 60):
+        self.queue = queue
+        self.partition_ttl = partition_ttl
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._previews = {}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def publish(self, job_id, type, **data):
+        with self._cond:
+            self._pending.setdefault(job_id, []).append({"type": type, **data})
+            self._cond.notify()
+
+    def publish_preview(self, job_id, **data):
+        with self._cond:
+            self._previews[job_id] = {"type": "preview", **data}
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._previews:
+                    self._cond.wait()
+
+                batches = self._pending
+                for job_id, preview in self._previews.items():
+                    events = batches.setdefault(job_id, [])
+                    if not events or events[-1]["type"] not in TERMINAL_EVENTS:
+                        events.append(preview)
+                self._pending = {}
+                self._previews = {}
+
+            for job_id, events in batches.items():
+                try:
+                    self.queue.put_many(
+                        events, partition=job_id, partition_ttl=self.partition_ttl
+                    )
+                except Exception as e:
+                    print(f"Error publishing events for {job_id}: {e}")
@@ -0,0 +1,47 @@
+import asyncio
+import collections
+import time
+
+
+class IdempotencyStore:
+    """Remembers which job was spawned for an idempotency key.
+
+    Entries live for `ttl` seconds and at most `max_size` are kept, oldest
+    evicted first. Concurrent submissions with the same key share one spawn.
+    A spawn that fails is forgotten so the client can retry it.
+
+    Keys are only known to the process holding the store, so retries must
+    reach the same API container; `api` is limited to one for that reason.
+    """
+
+    def __init__(self, ttl=60 * 10, max_size=10_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self._entries = collections.OrderedDict()
+
+    def _evict(self, now):
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_size:
+                break
+            del self._entries[key]
+
+    async def get_or_spawn(self, key, spawn):
+        """Returns the job id for `key`, awaiting `spawn()` only the first time."""
+        now = time.monotonic()
+        self._evict(now)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return await asyncio.shield(entry[1])
+
+        task = asyncio.ensure_future(spawn())
+        self._entries[key] = (now + self.ttl, task)
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            if self._entries.get(key, (None, None))[1] is task:
+                del self._entries[key]
+            raise
@@ -0,0 +1,108 @@
+import collections
+import os
+import pathlib
+import tempfile
+import threading
+
+
+def preprocessed_blob_name(image_key, node_id):
+    return f"preprocessed/{image_key}/{node_id}.png"
+
+
+def write_file(path, data):
+    """Writes `data` to `path` atomically, so readers never see half a file."""
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+
+class PreprocessorCache:
+    """Outputs of image-only preprocessor nodes, keyed by input image hash.
+
+    `preprocessors` maps each preprocessor node to the PreviewImage node that
+    shows its output. Those outputs are kept in ComfyUI's input directory, at
+    most `max_images` images' worth with the least recently used evicted, and
+    in the bucket when one is given. A later prompt on the same photo swaps
+    the preprocessor nodes for LoadImage nodes reading the stored outputs.
+    """
+
+    def __init__(
+        self,
+        preprocessors,
+        bucket=None,
+        input_dir="/root/input",
+        temp_dir="/root/temp",
+        max_images=256,
+    ):
+        self.preprocessors = preprocessors
+        self.previews = {preview: node for node, preview in preprocessors.items()}
+        self.bucket = bucket
+        self.input_dir = pathlib.Path(input_dir)
+        self.temp_dir = pathlib.Path(temp_dir)
+        self.max_images = max_images
+        self._lock = threading.Lock()
+        self._images = collections.OrderedDict()
+
+    def file_name(self, image_key, node_id):
+        return f"preprocessed/{image_key}-{node_id}.png"
+
+    def fetch(self, image_key):
+        """Returns `{node_id: file_name}` of the outputs stored for an image."""
+        if not self.preprocessors:
+            return {}
+
+        missing = [
+            node_id
+            for node_id in self.preprocessors
+            if not (self.input_dir / self.file_name(image_key, node_id)).exists()
+        ]
+        if missing and self.bucket is not None:
+            # One listing instead of a failed GET per node
+            for blob in self.bucket.list_blobs(prefix=f"preprocessed/{image_key}/"):
+                node_id = blob.name.rsplit("/", 1)[-1].removesuffix(".png")
+                if node_id in missing:
+                    write_file(
+                        self.input_dir / self.file_name(image_key, node_id),
+                        blob.download_as_bytes(),
+                    )
+
+        available = {
+            node_id: self.file_name(image_key, node_id)
+            for node_id in self.preprocessors
+            if (self.input_dir / self.file_name(image_key, node_id)).exists()
+        }
+        if available:
+            self._touch(image_key)
+        return available
+
+    def apply(self, graph, available):
+        """Replaces the preprocessors with stored outputs in a rendered graph."""
+        for node_id, file_name in available.items():
+            graph[node_id] = {"inputs": {"image": file_name}, "class_type": "LoadImage"}
+
+    def store(self, image_key, preview_node, output):
+        """Keeps the output a PreviewImage node reported in its `executed` event."""
+        node_id = self.previews[preview_node]
+        image = output["images"][0]
+        source = self.temp_dir / image.get("subfolder", "") / image["filename"]
+        data = source.read_bytes()
+
+        write_file(self.input_dir / self.file_name(image_key, node_id), data)
+        self._touch(image_key)
+        if self.bucket is not None:
+            blob = self.bucket.blob(preprocessed_blob_name(image_key, node_id))
+            blob.upload_from_string(data, content_type="image/png")
+
+    def _touch(self, image_key):
+        with self._lock:
+            self._images[image_key] = True
+            self._images.move_to_end(image_key)
+            evicted = []
+            while len(self._images) > self.max_images:
+                evicted.append(self._images.popitem(last=False)[0])
+
+        for key in evicted:
+            for node_id in self.preprocessors:
+                (self.input_dir / self.file_name(key, node_id)).unlink(missing_ok=True)
@@ -0,0 +1,81 @@
+import threading
+import time
+
+
+class ProgressWriter:
+    """Writes sampler progress to the job records from a background thread.
+
+    `update` only records the latest value for a session and returns
+    immediately, so a slow Firestore round trip never holds up the websocket
+    events of a job. A value is written once at least `min_interval` seconds
+    have passed since the last write of that record and it moved by at least
+    `min_delta` of the total; anything still pending is merged into the next
+    status transition by `flush`.
+    """
+
+    def __init__(self, records, min_interval=1.0, min_delta=0.1):
+        self.records = records
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._last = {}
+        self._writing = set()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def update(self, session_id, value, max):
+        with self._cond:
+            _, last_value = self._last.get(session_id, (0.0, None))
+            if (
+                last_value is not None
+                and value < max
+                and value - last_value < self.min_delta * max
+            ):
+                return
+
+            self._pending[session_id] = value
+            self._cond.notify()
+
+    def flush(self, session_id, transition, *args):
+        """Runs the `JobRecords` transition with any progress not yet sent."""
+        with self._cond:
+            pending = self._pending.pop(session_id, None)
+            # Let an in-flight "pending" write land first so it can't
+            # overwrite the status we are about to set.
+            while session_id in self._writing:
+                self._cond.wait()
+            self._last.pop(session_id, None)
+
+        transition(session_id, *args, progress=pending)
+
+    def _next_due(self):
+        now = time.monotonic()
+        wait = None
+        for key in self._pending:
+            last_time, _ = self._last.get(key, (0.0, None))
+            due_in = last_time + self.min_interval - now
+            if due_in <= 0:
+                return key, 0
+            wait = due_in if wait is None else min(wait, due_in)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key, wait = self._next_due()
+                while key is None:
+                    self._cond.wait(wait)
+                    key, wait = self._next_due()
+
+                value = self._pending.pop(key)
+                self._writing.add(key)
+
+            try:
+                self.records.pending(key, value)
+            except Exception as e:
+                print(f"Error writing progress for {key}: {e}")
+
+            with self._cond:
+                self._writing.discard(key)
+                self._last[key] = (time.monotonic(), value)
+                self._cond.notify_all()
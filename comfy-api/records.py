@@ -0,0 +1,177 @@
+import copy
+import datetime
+
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+class ArrayUnion:
+    def __init__(self, values):
+        self.values = values
+
+
+def _timestamp():
+    # Client-side timestamp as a dictionary
+    now_utc = datetime.datetime.now(datetime.timezone.utc)
+    return {"timestamp": now_utc.timestamp(), "iso": now_utc.isoformat()}
+
+
+class FirestoreBackend:
+    def __init__(self, db, collection="records"):
+        self.db = db
+        self.collection = db.collection(collection)
+
+    def _translate(self, fields):
+        from firebase_admin import firestore
+
+        translated = {}
+        for key, value in fields.items():
+            if isinstance(value, Increment):
+                value = firestore.Increment(value.value)
+            elif isinstance(value, ArrayUnion):
+                value = firestore.ArrayUnion(value.values)
+            translated[key] = value
+        return translated
+
+    def update(self, doc_id, fields):
+        self.collection.document(doc_id).update(self._translate(fields))
+
+    def update_if(self, doc_id, condition, fields):
+        """Updates the document only if `condition(document)` holds.
+
+        Read and write happen in one transaction. Returns whether it updated.
+        """
+        from firebase_admin import firestore
+
+        ref = self.collection.document(doc_id)
+
+        @firestore.transactional
+        def run(transaction):
+            snapshot = ref.get(transaction=transaction)
+            if not snapshot.exists or not condition(snapshot.to_dict()):
+                return False
+            transaction.update(ref, self._translate(fields))
+            return True
+
+        return run(self.db.transaction())
+
+    def get(self, doc_id):
+        doc = self.collection.document(doc_id).get()
+        return doc.to_dict() if doc.exists else None
+
+
+class InMemoryBackend:
+    """Stand-in for Firestore that counts round trips."""
+
+    def __init__(self, documents=None):
+        self.documents = documents if documents is not None else {}
+        self.reads = 0
+        self.writes = 0
+
+    def update(self, doc_id, fields):
+        self.writes += 1
+        if doc_id not in self.documents:
+            # Firestore's update() also refuses to create documents
+            raise KeyError(f"No document to update: {doc_id}")
+
+        document = self.documents[doc_id]
+        for key, value in fields.items():
+            if isinstance(value, Increment):
+                document[key] = document.get(key, 0) + value.value
+            elif isinstance(value, ArrayUnion):
+                existing = document.setdefault(key, [])
+                existing.extend(v for v in value.values if v not in existing)
+            else:
+                document[key] = value
+
+    def update_if(self, doc_id, condition, fields):
+        document = self.get(doc_id)
+        if document is None or not condition(document):
+            return False
+        self.update(doc_id, fields)
+        return True
+
+    def get(self, doc_id):
+        self.reads += 1
+        document = self.documents.get(doc_id)
+        return copy.deepcopy(document) if document is not None else None
+
+
+# Statuses of a record whose generation is still in progress
+ACTIVE_STATUSES = ("started", "pending", "executed")
+
+
+class JobRecords:
+    """Lifecycle of a generation in the `records` collection.
+
+    Every transition is a single write: counters and timestamp lists are
+    updated with atomic increments and array unions rather than a read
+    followed by a write, so concurrent generations of one session can't lose
+    an update.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def started(self, session_id, prompt_id, prompt):
+        self.backend.update(session_id, {
+            "prompt_id": prompt_id,
+            "prompt": prompt,
+            "status": "started",
+            "progress": 0,
+            "generation_count": Increment(1),
+            "generation_start_times": ArrayUnion([_timestamp()]),
+        })
+
+    def reused(self, session_id, prompt):
+        """Records a generation served from the result cache."""
+        timestamp = _timestamp()
+        self.backend.update(session_id, {
+            "prompt_id": None,
+            "prompt": prompt,
+            "status": "completed",
+            "generation_count": Increment(1),
+            "generation_start_times": ArrayUnion([timestamp]),
+            "generation_end_times": ArrayUnion([timestamp]),
+        })
+
+    def pending(self, session_id, progress):
+        self.backend.update(session_id, {"progress": progress, "status": "pending"})
+
+    def executed(self, session_id, progress=None):
+        self._transition(session_id, "executed", progress, {})
+
+    def completed(self, session_id, progress=None):
+        self._transition(session_id, "completed", progress, {
+            "generation_end_times": ArrayUnion([_timestamp()]),
+        })
+
+    def cancelled(self, session_id, prompt_id=None, progress=None):
+        """Marks the generation of `prompt_id` cancelled.
+
+        Records are per session, so one that a newer generation has taken
+        over is left alone. Without a `prompt_id`, for a job that never
+        queued a prompt, the record is only marked while idle. This is the
+        only transition that reads, so it can check that first.
+        """
+        fields = {"status": "cancelled"}
+        if progress is not None:
+            fields["progress"] = progress
+
+        def current(document):
+            if prompt_id is None:
+                return document.get("status") not in ACTIVE_STATUSES
+            return document.get("prompt_id") == prompt_id
+
+        return self.backend.update_if(session_id, current, fields)
+
+    def failed(self, session_id, error, progress=None):
+        self._transition(session_id, "failed", progress, {"error": error})
+
+    def _transition(self, session_id, status, progress, fields):
+        fields = {"status": status, **fields}
+        if progress is not None:
+            fields["progress"] = progress
+        self.backend.update(session_id, fields)
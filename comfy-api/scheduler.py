@@ -0,0 +1,181 @@
+import asyncio
+import collections
+import itertools
+import math
+import time
+
+
+class QueueFull(Exception):
+    def __init__(self, tenant, retry_after):
+        super().__init__(f"Too many queued jobs for {tenant}")
+        self.tenant = tenant
+        self.retry_after = retry_after
+
+
+class FairScheduler:
+    """Admission control and weighted fair queueing in front of spawning.
+
+    At most `max_in_flight` jobs are spawned at a time, matching the GPU
+    capacity behind them. Everything else waits in a queue per tenant, and
+    tenants are served in weighted fair order: each job gets a virtual finish
+    tag of `1 / weight` after its tenant's previous one, and the lowest tag
+    is spawned next. A busy tenant therefore can't push another tenant's
+    first job to the back of the line.
+    """
+
+    def __init__(
+        self,
+        max_in_flight,
+        max_queued_per_tenant=10,
+        weights=None,
+        default_weight=1.0,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queued_per_tenant = max_queued_per_tenant
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.in_flight = 0
+        # Running estimate of how long a job holds its slot, for Retry-After
+        self.job_seconds = 30.0
+        self._queues = collections.defaultdict(collections.deque)
+        self._last_tag = {}
+        self._virtual_time = 0.0
+        self._order = itertools.count()
+
+    def submit(self, tenant, spawn, wait, discard=None):
+        """Queues a job and returns the task that spawns it.
+
+        The task calls `spawn()` once a slot is free and it is the tenant's
+        turn, and resolves to its result; `wait(result)` must return once the
+        job finished, which frees the slot. Cancelling the task takes a job
+        that is still queued out of the queue. A job cancelled while `spawn()`
+        runs may exist already, so the spawn is finished and its result
+        handed to `discard(result)`. Raises `QueueFull` right away when the
+        tenant's queue is full.
+        """
+        queue = self._queues[tenant]
+        if len(queue) >= self.max_queued_per_tenant:
+            raise QueueFull(tenant, self.retry_after())
+
+        weight = self.weights.get(tenant, self.default_weight)
+        tag = max(self._virtual_time, self._last_tag.get(tenant, 0.0)) + 1 / weight
+        self._last_tag[tenant] = tag
+
+        turn = asyncio.get_running_loop().create_future()
+        entry = (tag, next(self._order), turn)
+        queue.append(entry)
+        self._dispatch()
+        return asyncio.ensure_future(self._run(queue, entry, spawn, wait, discard))
+
+    async def _run(self, queue, entry, spawn, wait, discard):
+        turn = entry[2]
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if entry in queue:
+                queue.remove(entry)
+            elif turn.done() and not turn.cancelled():
+                self._release()
+            raise
+
+        spawning = asyncio.ensure_future(spawn())
+        try:
+            result = await asyncio.shield(spawning)
+        except asyncio.CancelledError:
+            asyncio.ensure_future(self._discard(spawning, discard))
+            raise
+        except BaseException:
+            self._release()
+            raise
+
+        asyncio.ensure_future(self._hold(result, wait))
+        return result
+
+    async def _discard(self, spawning, discard):
+        try:
+            result = await spawning
+            if discard is not None:
+                await discard(result)
+        except Exception:
+            pass
+        finally:
+            self._release()
+
+    async def spawn_if_idle(self, spawn, wait):
+        """Spawns speculative work in a free slot, or returns None.
+
+        Only when no job is waiting and a slot is free, so the work never
+        delays a queued job. It holds its slot like a job does until
+        `wait(result)` returns.
+        """
+        if self.in_flight >= self.max_in_flight or any(self._queues.values()):
+            return None
+
+        self.in_flight += 1
+        try:
+            result = await spawn()
+        except BaseException:
+            self._release()
+            raise
+
+        asyncio.ensure_future(self._hold(result, wait, measure=False))
+        return result
+
+    async def _hold(self, result, wait, measure=True):
+        started_at = time.monotonic()
+        try:
+            await wait(result)
+        except Exception:
+            pass
+        finally:
+            if measure:
+                elapsed = time.monotonic() - started_at
+                self.job_seconds = 0.8 * self.job_seconds + 0.2 * elapsed
+            self._release()
+
+    def cancel_queued(self):
+        """Cancels every job still waiting for its turn, e.g. on shutdown.
+
+        Jobs already spawning are left to finish.
+        """
+        for queue in self._queues.values():
+            for _, _, turn in queue:
+                turn.cancel()
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight:
+            heads = [queue[0] for queue in self._queues.values() if queue]
+            if not heads:
+                return
+
+            tag, order, turn = min(heads)
+            for queue in self._queues.values():
+                if queue and queue[0][1] == order:
+                    queue.popleft()
+                    break
+
+            # Cancelled while waiting, `submit` is about to clean up after it
+            if turn.done():
+                continue
+
+            self._virtual_time = tag
+            self.in_flight += 1
+            turn.set_result(None)
+
+    def retry_after(self):
+        queued = sum(len(queue) for queue in self._queues.values())
+        waves = (queued + 1) / self.max_in_flight
+        return max(1, math.ceil(waves * self.job_seconds))
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": {
+                tenant: len(queue) for tenant, queue in self._queues.items() if queue
+            },
+        }
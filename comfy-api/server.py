@@ -0,0 +1,298 @@
+import collections
+import json
+import queue
+import subprocess
+import threading
+import time
+import urllib.request
+import uuid
+
+
+class ComfyServerError(RuntimeError):
+    pass
+
+
+class PromptInterrupted(ComfyServerError):
+    pass
+
+
+def is_terminal(event):
+    if event["type"] == "executing":
+        return event["data"]["node"] is None
+    return event["type"] in (
+        "execution_error",
+        "execution_interrupted",
+        "disconnected",
+    )
+
+
+class PromptWaiter:
+    """Receives the websocket events that belong to a single prompt."""
+
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self._events = queue.Queue()
+
+    def put(self, event):
+        self._events.put(event)
+
+    def events(self, timeout=None):
+        """Yields events until the prompt finishes, raising if it failed."""
+        while True:
+            event = self._events.get(timeout=timeout)
+            if event["type"] == "execution_error":
+                data = event["data"]
+                raise ComfyServerError(
+                    f"Node {data.get('node_id')} ({data.get('node_type')}) failed: "
+                    f"{data.get('exception_message')}"
+                )
+            if event["type"] == "execution_interrupted":
+                raise PromptInterrupted(f"Prompt {self.prompt_id} was interrupted")
+            if event["type"] == "disconnected":
+                raise ComfyServerError("Lost the websocket connection to ComfyUI")
+
+            yield event
+            if is_terminal(event):
+                return
+
+
+class ComfyServer:
+    """Runs the ComfyUI `main.py` subprocess and tracks when it is ready.
+
+    `start` launches the server and probes it from a background thread, so the
+    caller is never blocked. Everything that needs the server calls
+    `wait_ready`, which returns immediately once the gate is open.
+
+    Once the server is up a single websocket is kept open for the lifetime of
+    the container. Prompts are queued under its client id and a dispatcher
+    thread routes every event to the `PromptWaiter` of the prompt it belongs
+    to, so any number of prompts can be in flight at once.
+    """
+
+    # Events for prompts nobody has registered yet, e.g. when ComfyUI starts
+    # executing before `queue_prompt` has seen the response to its POST.
+    max_early_prompts = 64
+
+    def __init__(
+        self, port=8188, startup_timeout=60 * 5, preview_method="none", cache_lru=0
+    ):
+        self.port = port
+        self.preview_method = preview_method
+        self.cache_lru = cache_lru
+        self.url = f"http://0.0.0.0:{port}"
+        self.startup_timeout = startup_timeout
+        self.startup_time = None
+        self.process = None
+        self.client_id = uuid.uuid4().hex
+        self._error = None
+        self._ready = threading.Event()
+        self._ws = None
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._early = collections.OrderedDict()
+        self._current_prompt = None
+        self._current_node = None
+
+    def start(self):
+        cmd = (
+            f"python main.py --listen 0.0.0.0 --port {self.port} "
+            f"--preview-method {self.preview_method}"
+        )
+        if self.cache_lru:
+            # Keep node outputs of earlier prompts, not just the last one
+            cmd += f" --cache-lru {self.cache_lru}"
+        self.process = subprocess.Popen(cmd, shell=True)
+        threading.Thread(target=self._probe, daemon=True).start()
+
+    def _probe(self, initial_delay=0.05, max_delay=1.0):
+        started_at = time.monotonic()
+        delay = initial_delay
+        while True:
+            returncode = self.process.poll()
+            if returncode is not None:
+                self._error = ComfyServerError(
+                    f"ComfyUI exited with code {returncode} before becoming ready"
+                )
+                break
+
+            try:
+                with urllib.request.urlopen(f"{self.url}/prompt", timeout=2):
+                    pass
+                self._connect()
+                self.startup_time = time.monotonic() - started_at
+                print(f"ComfyUI ready after {self.startup_time:.2f}s")
+                break
+            except Exception:
+                pass
+
+            if time.monotonic() - started_at > self.startup_timeout:
+                self._error = ComfyServerError(
+                    f"ComfyUI did not become ready within {self.startup_timeout}s"
+                )
+                break
+
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+        self._ready.set()
+
+    def wait_ready(self, timeout=None):
+        if not self._ready.wait(timeout):
+            raise TimeoutError("Timed out waiting for ComfyUI to start")
+        if self._error is not None:
+            raise self._error
+
+        returncode = self.process.poll()
+        if returncode is not None:
+            raise ComfyServerError(f"ComfyUI exited with code {returncode}")
+
+    def _connect(self):
+        import websocket
+
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://0.0.0.0:{self.port}/ws?clientId={self.client_id}")
+        first_connection = self._ws is None
+        self._ws = ws
+        if first_connection:
+            threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                out = self._ws.recv()
+            except Exception as e:
+                print(f"ComfyUI websocket closed: {e}")
+                self._fail_pending()
+                if not self._reconnect():
+                    return
+                continue
+
+            self._dispatch(out)
+
+    def _reconnect(self, initial_delay=0.1, max_delay=2.0):
+        delay = initial_delay
+        while self.process.poll() is None:
+            try:
+                self._connect()
+                return True
+            except Exception:
+                time.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+        # The server is gone for good, so there is nothing to reconnect to.
+        self._error = ComfyServerError(
+            f"ComfyUI exited with code {self.process.returncode}"
+        )
+        return False
+
+    def _fail_pending(self):
+        with self._lock:
+            waiters = list(self._waiters.values())
+            self._waiters.clear()
+            self._early.clear()
+            self._current_prompt = self._current_node = None
+
+        for waiter in waiters:
+            waiter.put({"type": "disconnected", "data": {}})
+
+    def _dispatch(self, out):
+        if isinstance(out, str):
+            message = json.loads(out)
+            data = message.get("data") or {}
+            prompt_id = data.get("prompt_id")
+
+            if message["type"] == "executing":
+                self._current_node = data.get("node")
+                self._current_prompt = prompt_id if self._current_node else None
+
+            if prompt_id is not None:
+                self._route(prompt_id, message)
+        elif self._current_prompt is not None:
+            # Binary frames carry no prompt id; ComfyUI executes one prompt at a
+            # time, so they belong to whichever prompt is currently executing.
+            # The first 8 bytes are the event type and the image format.
+            self._route(
+                self._current_prompt,
+                {"type": "image", "node": self._current_node, "data": out[8:]},
+            )
+
+    def _route(self, prompt_id, event):
+        with self._lock:
+            waiter = self._waiters.get(prompt_id)
+            if waiter is None:
+                self._early.setdefault(prompt_id, []).append(event)
+                while len(self._early) > self.max_early_prompts:
+                    self._early.popitem(last=False)
+                return
+
+            if is_terminal(event):
+                del self._waiters[prompt_id]
+
+        waiter.put(event)
+
+    def queue_prompt(self, workflow):
+        """Queues a prompt graph, or its JSON, and returns its waiter."""
+        if not isinstance(workflow, str):
+            workflow = json.dumps(workflow)
+        data = f'{{"prompt": {workflow}, "client_id": {json.dumps(self.client_id)}}}'
+        request = urllib.request.Request(
+            f"{self.url}/prompt", data=data.encode("utf-8")
+        )
+        result = json.loads(urllib.request.urlopen(request).read())
+        return self._register(result["prompt_id"])
+
+    def _register(self, prompt_id):
+        waiter = PromptWaiter(prompt_id)
+        with self._lock:
+            finished = False
+            for event in self._early.pop(waiter.prompt_id, []):
+                waiter.put(event)
+                finished = finished or is_terminal(event)
+            if not finished:
+                self._waiters[waiter.prompt_id] = waiter
+
+        return waiter
+
+    def cancel(self, prompt_id):
+        """Stops a prompt, taking it out of the queue or interrupting it.
+
+        Which prompt runs is asked from ComfyUI itself rather than taken from
+        the websocket, which may lag behind, so a plain `/interrupt` can't
+        hit another job's prompt.
+        """
+        state = self._prompt_state(prompt_id)
+        if state == "pending":
+            self._post("queue", {"delete": [prompt_id]})
+            # It may have started just before the delete
+            state = self._prompt_state(prompt_id)
+            if state is None:
+                # A prompt removed from the queue never produces any events
+                self._route(
+                    prompt_id,
+                    {"type": "execution_interrupted", "data": {"prompt_id": prompt_id}},
+                )
+                return
+
+        if state == "running":
+            # ComfyUI versions that know `prompt_id` also skip the interrupt if
+            # another prompt started in the meantime
+            self._post("interrupt", {"prompt_id": prompt_id})
+
+    def _prompt_state(self, prompt_id):
+        """Whether ComfyUI has the prompt "running", "pending" or neither."""
+        with urllib.request.urlopen(f"{self.url}/queue") as response:
+            items = json.loads(response.read())
+        # Queue items are [number, prompt_id, prompt, extra_data, outputs]
+        if any(item[1] == prompt_id for item in items["queue_running"]):
+            return "running"
+        if any(item[1] == prompt_id for item in items["queue_pending"]):
+            return "pending"
+        return None
+
+    def _post(self, path, data):
+        request = urllib.request.Request(
+            f"{self.url}/{path}",
+            data=json.dumps(data).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        urllib.request.urlopen(request).read()
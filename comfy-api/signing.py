@@ -0,0 +1,65 @@
+import collections
+import datetime
+import threading
+import time
+
+
+class SignedUrlCache:
+    """LRU cache of signed blob URLs.
+
+    Signing is an RSA operation with the service account key, and booths ask
+    for the same few URLs over and over. A URL is handed out again until less
+    than `min_remaining` of its lifetime is left, after which the next request
+    signs a fresh one, so callers always get at least `min_remaining` of
+    validity.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        lifetime=datetime.timedelta(minutes=30),
+        min_remaining=datetime.timedelta(minutes=10),
+        max_size=4096,
+    ):
+        self.bucket = bucket
+        self.lifetime = lifetime
+        self.min_remaining = min_remaining.total_seconds()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, blob_name, method="GET"):
+        key = (blob_name, method)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] - now > self.min_remaining:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        url = self.bucket.blob(blob_name).generate_signed_url(
+            expiration=self.lifetime, method=method
+        )
+
+        with self._lock:
+            # Measured from before signing, so it never overestimates
+            self._entries[key] = (url, now + self.lifetime.total_seconds())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return url
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "size": len(self._entries),
+            }
@@ -0,0 +1,40 @@
+import contextlib
+import time
+
+
+def variant_stage(name, index, count):
+    """Stage name of one image of a job, so variants don't overwrite each other.
+
+    Single-image jobs keep the plain name.
+    """
+    return name if count == 1 else f"{name}_{index}"
+
+
+class Timings:
+    """Wall-clock duration of each stage of a job, in seconds."""
+
+    def __init__(self):
+        self.stages = {}
+        self._started_at = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - started_at
+
+    def submit(self, pool, name, fn, *args, **kwargs):
+        """Runs `fn` on `pool` as the stage `name` and returns its future."""
+
+        def run():
+            with self.stage(name):
+                return fn(*args, **kwargs)
+
+        return pool.submit(run)
+
+    def as_dict(self):
+        stages = {name: round(seconds, 3) for name, seconds in self.stages.items()}
+        stages["total"] = round(time.perf_counter() - self._started_at, 3)
+        return stages
@@ -0,0 +1,120 @@
+import json
+import pathlib
+
+# Where the container image keeps the workflow files
+WORKFLOW_DIR = "/root/workflows"
+
+# Named inputs of workflow_api.json: the node and input each one patches, and
+# whether the value replaces the input or is appended to it
+PARAMETERS = {
+    "image": ("1", "image", "set"),
+    "prompt": ("9", "text", "append"),
+    "seed": ("11", "seed", "set"),
+    "steps": ("11", "steps", "set"),
+    "batch_size": ("12", "batch_size", "set"),
+}
+
+# Workflows a job can select by name. Every workflow runs in its own pool of
+# GPU containers, so its `models` (paths under /root/models) stay loaded and a
+# job never waits for another workflow's checkpoints to be swapped out. Each
+# one must define the `image`, `prompt` and `seed` parameters, and
+# `batch_size` to generate variants. `preprocessors` maps the image-only
+# preprocessor nodes to the PreviewImage nodes that expose their outputs.
+WORKFLOWS = {
+    "default": {
+        "file": "workflow_api.json",
+        "parameters": PARAMETERS,
+        "models": [
+            "checkpoints/dreamshaperXL_alpha2Xl10.safetensors",
+            "controlnet/control-lora-depth-rank256.safetensors",
+            "controlnet/control-lora-openposeXL2-rank256.safetensors",
+            "clip_vision/CLIP-ViT-H-14-laion2B-s32B-b79K.safetensors",
+            "ipadapter/ip-adapter-plus_sdxl_vit-h.safetensors",
+            "insightface/inswapper_128.onnx",
+            "facerestore_models/codeformer-v0.1.0.pth",
+        ],
+        "preprocessors": {"62": "47", "73": "71"},
+    },
+}
+
+
+def load_workflow(name, directory=WORKFLOW_DIR):
+    path = pathlib.Path(directory) / WORKFLOWS[name]["file"]
+    return json.loads(path.read_text())
+
+
+def subgraph(graph, outputs):
+    """The nodes of `graph` that `outputs` depend on, themselves included."""
+    nodes = {}
+    pending = list(outputs)
+    while pending:
+        node_id = pending.pop()
+        if node_id in nodes:
+            continue
+        nodes[node_id] = graph[node_id]
+        for value in graph[node_id]["inputs"].values():
+            # Links are [node_id, output_index]
+            if isinstance(value, list) and len(value) == 2 and value[0] in graph:
+                pending.append(value[0])
+    return nodes
+
+
+def missing_models(name, models_dir="/root/models"):
+    return [
+        model
+        for model in WORKFLOWS[name]["models"]
+        if not (pathlib.Path(models_dir) / model).exists()
+    ]
+
+
+class WorkflowTemplate:
+    """An API-format workflow with named parameters, compiled once.
+
+    `render` builds the graph of a single request by copying only the nodes
+    its parameters patch; every other node is shared with the template and
+    must not be modified. `dumps` serializes such a graph for `/prompt`,
+    reusing the cached JSON of every shared node.
+    """
+
+    def __init__(self, workflow, parameters=PARAMETERS):
+        for name, (node_id, input_name, mode) in parameters.items():
+            if input_name not in workflow.get(node_id, {}).get("inputs", {}):
+                raise ValueError(
+                    f"Parameter {name} refers to a missing input: "
+                    f"{node_id}.{input_name}"
+                )
+            if mode not in ("set", "append"):
+                raise ValueError(f"Unknown mode for parameter {name}: {mode}")
+
+        self.workflow = workflow
+        self.parameters = parameters
+        self._fragments = {
+            node_id: f"{json.dumps(node_id)}: {json.dumps(node)}"
+            for node_id, node in workflow.items()
+        }
+
+    def render(self, **values):
+        graph = dict(self.workflow)
+        for name, value in values.items():
+            if name not in self.parameters:
+                raise TypeError(f"Unknown workflow parameter: {name}")
+
+            node_id, input_name, mode = self.parameters[name]
+            node = graph[node_id]
+            if node is self.workflow[node_id]:
+                node = graph[node_id] = {**node, "inputs": dict(node["inputs"])}
+
+            if mode == "append":
+                value = node["inputs"][input_name] + value
+            node["inputs"][input_name] = value
+
+        return graph
+
+    def dumps(self, graph):
+        fragments = []
+        for node_id, node in graph.items():
+            if node is self.workflow.get(node_id):
+                fragments.append(self._fragments[node_id])
+            else:
+                fragments.append(f"{json.dumps(node_id)}: {json.dumps(node)}")
+        return "{" + ", ".join(fragments) + "}"
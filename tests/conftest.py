@@ -0,0 +1,6 @@
+import pathlib
+import sys
+
+# The modules under test import nothing from the rest of the package, so they
+# load without Modal or Firebase installed
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "comfy-api"))
@@ -0,0 +1,59 @@
+import pytest
+
+from records import InMemoryBackend, JobRecords
+
+
+@pytest.fixture
+def backend():
+    return InMemoryBackend({"session": {"generation_count": 2}})
+
+
+@pytest.fixture
+def records(backend):
+    return JobRecords(backend)
+
+
+@pytest.mark.parametrize(
+    "transition, args",
+    [
+        ("started", ("prompt", "a photo")),
+        ("reused", ("a photo",)),
+        ("pending", (40,)),
+        ("executed", ()),
+        ("completed", ()),
+        ("failed", ("boom",)),
+    ],
+)
+def test_transition_is_one_write_and_no_read(backend, records, transition, args):
+    getattr(records, transition)("session", *args)
+
+    assert backend.writes == 1
+    assert backend.reads == 0
+
+
+def test_started_increments_the_generation_count(backend, records):
+    records.started("session", "first", "a photo")
+    records.started("session", "second", "a photo")
+
+    document = backend.documents["session"]
+    assert document["generation_count"] == 4
+    assert document["prompt_id"] == "second"
+    assert document["status"] == "started"
+
+
+def test_cancelled_leaves_a_newer_generation_alone(backend, records):
+    records.started("session", "newer", "a photo")
+
+    assert not records.cancelled("session", "older")
+    assert backend.documents["session"]["status"] == "started"
+
+    assert records.cancelled("session", "newer")
+    assert backend.documents["session"]["status"] == "cancelled"
+
+
+def test_cancelled_without_a_prompt_waits_for_an_idle_record(backend, records):
+    records.started("session", "running", "a photo")
+    assert not records.cancelled("session")
+
+    records.completed("session")
+    assert records.cancelled("session")